@@ -1,17 +1,43 @@
+import asyncio
+import base64
+import contextvars
+import csv
+import functools
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
 import os
+import re
+import shutil
 import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
 import traceback
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime, timezone
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatMemberStatus
-from telegram.error import NetworkError
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
@@ -51,64 +77,645 @@ def load_database_url() -> str | None:
     return None
 
 
-TOKEN = load_token()
+@functools.cache
+def bot_token() -> str:
+    # read on first use, not at import: web.py must come up even without one
+    return load_token()
+
+
 DATABASE_URL = load_database_url()
 USING_PG = bool(DATABASE_URL)
 
 # ---------- ADMIN ----------
 ADMIN_IDS = {6474515118}
 
+# ---------- CONFIG ----------
+def env_int(name: str, default: int) -> int:
+    v = os.environ.get(name)
+    if v and v.strip():
+        try:
+            return int(v.strip())
+        except ValueError:
+            pass
+    return default
+
+
+def env_float(name: str, default: float) -> float:
+    v = os.environ.get(name)
+    if v and v.strip():
+        try:
+            return float(v.strip())
+        except ValueError:
+            pass
+    return default
+
+
+DB_POOL_MIN = env_int("DB_POOL_MIN", 1)
+DB_POOL_MAX = env_int("DB_POOL_MAX", 10)
+DB_POOL_TIMEOUT = env_float("DB_POOL_TIMEOUT", 30.0)
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bot.db")
+SQLITE_READERS = env_int("SQLITE_READERS", 4)
+SQLITE_WRITE_BATCH = env_int("SQLITE_WRITE_BATCH", 500)    # statements per commit
+SQLITE_CACHE_MB = env_int("SQLITE_CACHE_MB", 32)           # page cache per connection
+SQLITE_BUSY_TIMEOUT = env_int("SQLITE_BUSY_TIMEOUT", 5000)  # ms, when another process holds the lock
+
+# ---------- METRICS ----------
+# Prometheus text format, served by web.py on /metrics. Recording is
+# lock-free: each thread writes into its own shard (a threading.local dict),
+# and only render() walks all shards and sums them. Gauges are callbacks
+# evaluated at scrape time; so are counters that an object already keeps
+# (metrics.counter), which get a _total name like the recorded ones.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()  # taken once per thread, on its first write
+        self._meta = {}     # name -> (type, help)
+        self._gauges = []   # (name, fn) ; fn() -> number or [(labels, number), ...], gauges and counters
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})  # counters, histograms
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        hists = self._shard()[1]
+        key = (name, labels)
+        h = hists.get(key)
+        if h is None:
+            h = hists[key] = [0] * (len(LATENCY_BUCKETS) + 2)  # buckets..., count, sum
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+                break
+        h[-2] += 1
+        h[-1] += value
+
+    def gauge(self, name: str, help_text: str, fn):
+        self.describe(name, "gauge", help_text)
+        self._gauges.append((name, fn))
+
+    def counter(self, name: str, help_text: str, fn):
+        # fn() must only ever grow (until the process restarts)
+        self.describe(name, "counter", help_text)
+        self._gauges.append((name, fn))
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{str(v)}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def snapshot(self):
+        counters, hists = {}, {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for c, h in shards:
+            for key, v in list(c.items()):
+                counters[key] = counters.get(key, 0) + v
+            for key, v in list(h.items()):
+                acc = hists.get(key)
+                if acc is None:
+                    hists[key] = list(v)
+                else:
+                    for i, x in enumerate(v):
+                        acc[i] += x
+        return counters, hists
+
+    def render(self) -> str:
+        counters, hists = self.snapshot()
+        by_name = {}
+        for (name, labels), v in counters.items():
+            by_name.setdefault(name, []).append(f"{name}{self._labels(labels)} {v}")
+        for (name, labels), h in hists.items():
+            lines = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, h):
+                cumulative += n
+                le = self._labels(labels, 'le="%s"' % bound)
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            le = self._labels(labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{le} {h[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {h[-2]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-1]:.6f}")
+        for name, fn in self._gauges:
+            try:
+                v = fn()
+            except Exception:
+                continue
+            lines = by_name.setdefault(name, [])
+            if isinstance(v, list):
+                lines.extend(f"{name}{self._labels(labels)} {x}" for labels, x in v)
+            else:
+                lines.append(f"{name} {v}")
+        out = []
+        for name in sorted(by_name):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(by_name[name])
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Handler latency by handler and branch")
+metrics.describe("bot_handler_errors_total", "counter", "Handler exceptions by handler and branch")
+metrics.describe("bot_db_query_seconds", "histogram", "DB call latency by operation")
+metrics.describe("bot_db_errors_total", "counter", "Failed DB calls by operation")
+metrics.describe("bot_telegram_api_seconds", "histogram", "Bot API request latency by method")
+metrics.describe("bot_telegram_api_errors_total", "counter", "Bot API errors by method and status")
+
+
+# Handlers report which branch they took through mark_branch(); the label
+# defaults to "-" when a handler returns before picking one.
+_branch = contextvars.ContextVar("handler_branch", default=None)
+
+
+def mark_branch(name: str):
+    slot = _branch.get()
+    if slot is not None:
+        slot[0] = name
+
+
+def timed_handler(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            slot = ["-"]
+            token = _branch.set(slot)
+            health.last_update_at = time.time()
+            t0 = time.perf_counter()
+            try:
+                return await fn(update, context)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", (("handler", name), ("branch", slot[0])))
+                raise
+            finally:
+                _branch.reset(token)
+                metrics.observe("bot_handler_seconds", (("handler", name), ("branch", slot[0])),
+                                time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+
+def db_timed(op: str):
+    labels = (("op", op),)
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                metrics.inc("bot_db_errors_total", labels)
+                raise
+            finally:
+                metrics.observe("bot_db_query_seconds", labels, time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+
+def db_timed_stream(op: str):
+    # q_stream is an async generator: each chunk fetched (the first one
+    # includes running the query) is timed as one query
+    labels = (("op", op),)
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            chunks = fn(*args, **kwargs)
+            try:
+                while True:
+                    t0 = time.perf_counter()
+                    try:
+                        rows = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    except Exception:
+                        metrics.inc("bot_db_errors_total", labels)
+                        raise
+                    finally:
+                        metrics.observe("bot_db_query_seconds", labels, time.perf_counter() - t0)
+                    yield rows
+            finally:
+                await chunks.aclose()
+        return wrapper
+    return deco
+
+
+# ---------- TEXT NORMALIZATION ----------
+# Full-text search (see FULL-TEXT SEARCH) indexes and queries normalized text,
+# so Arabic and Persian spellings of the same letter, Persian/Arabic digits,
+# diacritics, tatweel and zero-width joiners don't split matches. The same
+# mapping is the SQL function fts_normalize() on Postgres (an IMMUTABLE
+# translate(), used by the indexed column) and a Python function registered
+# under that name on every SQLite connection.
+FTS_CHAR_MAP = {
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "ٱ": "ا", "ؤ": "و",
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # Persian digits
+}
+# tashkeel, superscript alef, tatweel, ZWNJ, ZWJ
+FTS_DROP_CHARS = "".join(chr(c) for c in range(0x064B, 0x0653)) + "\u0670\u0640\u200c\u200d"
+FTS_FROM = "".join(FTS_CHAR_MAP)
+FTS_TO = "".join(FTS_CHAR_MAP.values())
+FTS_TRANSLATION = str.maketrans(FTS_FROM, FTS_TO, FTS_DROP_CHARS)
+
+
+def fts_normalize(text: str | None) -> str:
+    return (text or "").translate(FTS_TRANSLATION).lower()
+
+
 # =========================
-#   DATABASE (Postgres via psycopg3 + auto reconnect OR SQLite fallback)
+#   DATABASE (async: psycopg AsyncConnectionPool OR SQLite writer thread + read connections)
 # =========================
-cur = None
-db = None
+# All access goes through the coroutines below so a DB round-trip never blocks
+# the PTB event loop:
+#   q(sql, params)       -> execute, no result
+#   q_one(sql, params)   -> first row or None
+#   q_all(sql, params)   -> list of rows
+#   q_many(sql, seq)     -> executemany
+#   q_stream(sql, params, size) -> async iterator of row chunks, bounded memory
+#   q_tx(steps)          -> run [(sql, params), ...] in one transaction
+#   apply_migration(...) -> run one schema migration in its own transaction
+pool = None
 
 def now_ts() -> int:
     return int(time.time())
 
 
 if USING_PG:
-    import psycopg
-    from psycopg import OperationalError
+    from psycopg_pool import AsyncConnectionPool
 
-    def db_connect():
-        global db, cur
-        db = psycopg.connect(DATABASE_URL)
-        db.autocommit = True
-        cur = db.cursor()
+    async def db_open():
+        # a closed pool can't be reopened, so every run_bot iteration gets a fresh one
+        global pool
+        if pool is not None:
+            return
+        pool = AsyncConnectionPool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            kwargs={"autocommit": True},
+            # health check on checkout: dead connections (Neon idle timeout,
+            # pooler restarts) are discarded and replaced instead of erroring
+            check=AsyncConnectionPool.check_connection,
+            max_idle=300,
+            open=False,
+        )
+        await pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
 
-    db_connect()
+    async def db_close():
+        global pool
+        if pool is not None:
+            p, pool = pool, None
+            await p.close()
 
-    def q(sql: str, params=None):
-        global cur
-        try:
-            cur.execute(sql, params or ())
-        except OperationalError as e:
-            msg = str(e).lower()
-            if (
-                "connection is lost" in msg
-                or "closed" in msg
-                or "terminated" in msg
-                or "server closed the connection" in msg
-                or "connection not open" in msg
-            ):
-                db_connect()
-                cur.execute(sql, params or ())
-                return
-            raise
+    @db_timed("q")
+    async def q(sql: str, params=None):
+        async with pool.connection() as conn:
+            await conn.execute(sql, params or ())
+
+    @db_timed("q_one")
+    async def q_one(sql: str, params=None):
+        async with pool.connection() as conn:
+            c = await conn.execute(sql, params or ())
+            return await c.fetchone()
+
+    @db_timed("q_all")
+    async def q_all(sql: str, params=None):
+        async with pool.connection() as conn:
+            c = await conn.execute(sql, params or ())
+            return await c.fetchall()
+
+    @db_timed("q_many")
+    async def q_many(sql: str, seq):
+        seq = list(seq)
+        if not seq:
+            return
+        async with pool.connection() as conn:
+            async with conn.cursor() as c:
+                await c.executemany(sql, seq)
+
+    @db_timed_stream("q_stream")
+    async def q_stream(sql: str, params=None, size: int = 1000):
+        # server-side (named) cursor: rows arrive size at a time
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor(name=f"stream_{id(conn)}_{now_ts()}") as c:
+                    c.itersize = size
+                    await c.execute(sql, params or ())
+                    while True:
+                        rows = await c.fetchmany(size)
+                        if not rows:
+                            break
+                        yield rows
+
+    @db_timed("q_tx")
+    async def q_tx(steps):
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                for sql, params in steps:
+                    await conn.execute(sql, params)
+
+    MIGRATION_LOCK_ID = 55596
+
+    async def apply_migration(version: int, name: str, steps) -> bool:
+        # the advisory lock serializes concurrent instances starting up together
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                c = await conn.execute("SELECT 1 FROM schema_migrations WHERE version=%s", (version,))
+                if await c.fetchone():
+                    return False
+                for sql in steps:
+                    await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s,%s,%s)",
+                    (version, name, now_ts())
+                )
+                return True
 
 else:
-    db = sqlite3.connect("bot.db", check_same_thread=False)
-    cur = db.cursor()
+    import queue
+
+    # One writer thread owns the only read-write connection. Writes are queued
+    # and everything waiting at the start of a tick is committed in a single
+    # transaction (one fsync), each statement under its own savepoint so a
+    # failing one doesn't take the rest down. Reads go to a small pool of
+    # read-only connections, which WAL lets run alongside the writer. A write
+    # returns only after its commit, so a following read always sees it.
+    SQLITE_READ_RE = re.compile(r"\s*(SELECT|WITH)\b", re.IGNORECASE)
+
+    def _sqlite_connect(read_only: bool) -> sqlite3.Connection:
+        # isolation_level=None: no implicit transactions, the writer issues BEGIN/COMMIT
+        conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        conn.execute(f"PRAGMA cache_size={-SQLITE_CACHE_MB * 1024}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.create_function("fts_normalize", 1, fts_normalize, deterministic=True)
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        else:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: a crash can lose the last commits, never corrupt the file
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _settle(fut: asyncio.Future, result, error):
+        if fut.done():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    class SQLiteWriter:
+        def __init__(self):
+            self.jobs = queue.SimpleQueue()  # (fn(conn) -> result, future, loop) or None to stop
+            self.conn = None
+            self.thread = None
+            self.commits = 0
+            self.statements = 0
+
+        def open(self):
+            self.conn = _sqlite_connect(read_only=False)
+            self.thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+            self.thread.start()
+
+        def close(self):
+            # queued jobs ahead of the sentinel still get written
+            self.jobs.put(None)
+            self.thread.join()
+            self.conn.close()
+
+        def pending(self) -> int:
+            return self.jobs.qsize()
+
+        async def submit(self, fn):
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            self.jobs.put((fn, fut, loop))
+            return await fut
+
+        def _run(self):
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                batch = [job]
+                stop = False
+                while len(batch) < SQLITE_WRITE_BATCH:
+                    try:
+                        job = self.jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stop = True
+                        break
+                    batch.append(job)
+                self._commit(batch)
+                if stop:
+                    return
+
+        def _commit(self, batch):
+            conn = self.conn
+            done = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, fut, loop in batch:
+                    conn.execute("SAVEPOINT job")
+                    try:
+                        result = fn(conn)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO job")
+                        done.append((fut, loop, None, e))
+                    else:
+                        done.append((fut, loop, result, None))
+                    conn.execute("RELEASE job")
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                done = [(fut, loop, None, e) for fut, loop in ((j[1], j[2]) for j in batch)]
+            else:
+                self.commits += 1
+                self.statements += len(batch)
+            for fut, loop, result, error in done:
+                loop.call_soon_threadsafe(_settle, fut, result, error)
+
+    sqlite_writer = None
+    sqlite_readers = None  # queue.SimpleQueue of read-only connections
+
+    metrics.gauge("bot_sqlite_write_queue", "Writes waiting for the SQLite writer thread",
+                  lambda: sqlite_writer.pending() if sqlite_writer else 0)
+    metrics.counter("bot_sqlite_commits_total", "Transactions committed by the SQLite writer",
+                    lambda: sqlite_writer.commits if sqlite_writer else 0)
+    metrics.counter("bot_sqlite_statements_total", "Statements written by the SQLite writer",
+                    lambda: sqlite_writer.statements if sqlite_writer else 0)
+
+    async def db_open():
+        global sqlite_writer, sqlite_readers
+        if sqlite_writer is not None:
+            return
+        writer = SQLiteWriter()
+        # the writer connection switches the file to WAL before any reader opens it
+        await asyncio.to_thread(writer.open)
+        readers = queue.SimpleQueue()
+        for _ in range(max(1, SQLITE_READERS)):
+            readers.put(await asyncio.to_thread(_sqlite_connect, True))
+        sqlite_writer, sqlite_readers = writer, readers
+
+    async def db_close():
+        global sqlite_writer, sqlite_readers
+        if sqlite_writer is None:
+            return
+        writer, readers = sqlite_writer, sqlite_readers
+        sqlite_writer = sqlite_readers = None
+        await asyncio.to_thread(writer.close)
+        while not readers.empty():
+            readers.get().close()
+
+    def _sqlite_read(sql: str, params, fetch: str):
+        conn = sqlite_readers.get()
+        try:
+            c = conn.execute(sql, params or ())
+            return c.fetchone() if fetch == "one" else c.fetchall()
+        finally:
+            sqlite_readers.put(conn)
+
+    def _is_read(sql: str) -> bool:
+        return SQLITE_READ_RE.match(sql) is not None and "RETURNING" not in sql.upper()
+
+    async def _sqlite_fetch(sql: str, params, fetch: str):
+        if _is_read(sql):
+            return await asyncio.to_thread(_sqlite_read, sql, params, fetch)
+
+        def write(conn):
+            c = conn.execute(sql, params or ())
+            return c.fetchone() if fetch == "one" else c.fetchall()
+        return await sqlite_writer.submit(write)
+
+    @db_timed("q")
+    async def q(sql: str, params=None):
+        await sqlite_writer.submit(lambda conn: conn.execute(sql, params or ()).close())
+
+    @db_timed("q_one")
+    async def q_one(sql: str, params=None):
+        return await _sqlite_fetch(sql, params, "one")
+
+    @db_timed("q_all")
+    async def q_all(sql: str, params=None):
+        return await _sqlite_fetch(sql, params, "all")
+
+    @db_timed("q_many")
+    async def q_many(sql: str, seq):
+        seq = list(seq)
+        if not seq:
+            return
+        await sqlite_writer.submit(lambda conn: conn.executemany(sql, seq).close())
 
-    def q(sql: str, params=None):
-        cur.execute(sql, params or ())
-        db.commit()
+    def _sqlite_stream_open(sql: str, params):
+        conn = _sqlite_connect(read_only=True)
+        return conn, conn.execute(sql, params or ())
 
+    @db_timed_stream("q_stream")
+    async def q_stream(sql: str, params=None, size: int = 1000):
+        # dedicated connection so a long export doesn't hold one of the pooled readers
+        conn, c = await asyncio.to_thread(_sqlite_stream_open, sql, params)
+        try:
+            while True:
+                rows = await asyncio.to_thread(c.fetchmany, size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await asyncio.to_thread(conn.close)
+
+    @db_timed("q_tx")
+    async def q_tx(steps):
+        def tx(conn):
+            for sql, params in steps:
+                conn.execute(sql, params or ())
+        await sqlite_writer.submit(tx)
+
+    async def apply_migration(version: int, name: str, steps) -> bool:
+        # the writer runs one job at a time, and BEGIN IMMEDIATE keeps other processes out
+        def migrate(conn):
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version=?", (version,)).fetchone():
+                return False
+            for sql in steps:
+                conn.execute(sql)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?,?,?)",
+                (version, name, now_ts())
+            )
+            return True
+        return await sqlite_writer.submit(migrate)
+
+
+# ---------- schema migrations ----------
+# Applied in order, each in its own transaction, and recorded in
+# schema_migrations. Never edit a shipped migration: append a new one.
+# Entries: (version, name, postgres statements, sqlite statements).
+
+# migration 9, same SQL on both backends: each old per-mode key, in the
+# order the message handler used to test them, becomes conv = arg * 16 + code
+CONV_MIGRATION = [
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', 6, updated_at FROM user_state WHERE key='admin_set_channel' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', 7, updated_at FROM user_state WHERE key='admin_set_link' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', 8, updated_at FROM user_state WHERE key='admin_anon_target' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', value * 16 + 9, updated_at FROM user_state WHERE key='admin_anon_message' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', 4, updated_at FROM user_state WHERE key='admin_search' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', 5, updated_at FROM user_state WHERE key='admin_broadcast' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', value * 16 + 2, updated_at FROM user_state WHERE key='reply' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', 3, updated_at FROM user_state WHERE key='direct' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "INSERT INTO user_state (user_id, key, value, updated_at) "
+    "SELECT user_id, 'conv', value * 16 + 1, updated_at FROM user_state WHERE key='link' "
+    "ON CONFLICT (user_id, key) DO NOTHING",
+    "DELETE FROM user_state WHERE key IN ("
+    "'link', 'reply', 'direct', 'admin_search', 'admin_broadcast', "
+    "'admin_set_channel', 'admin_set_link', 'admin_anon_target', 'admin_anon_message')",
+]
 
-# ---------- schema ----------
-q("""
+
+MIGRATIONS = [
+    (1, "base tables", [
+        """
 CREATE TABLE IF NOT EXISTS users (
     user_id BIGINT PRIMARY KEY,
     username TEXT,
@@ -116,9 +723,8 @@ CREATE TABLE IF NOT EXISTS users (
     is_admin INTEGER,
     last_seen BIGINT
 )
-""")
-
-q("""
+""",
+        """
 CREATE TABLE IF NOT EXISTS messages (
     id BIGSERIAL PRIMARY KEY,
     sender_id BIGINT,
@@ -127,7 +733,24 @@ CREATE TABLE IF NOT EXISTS messages (
     content TEXT,
     ts BIGINT
 )
-""" if USING_PG else """
+""",
+        """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)
+""",
+    ], [
+        """
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    full_name TEXT,
+    is_admin INTEGER,
+    last_seen BIGINT
+)
+""",
+        """
 CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     sender_id INTEGER,
@@ -136,398 +759,2668 @@ CREATE TABLE IF NOT EXISTS messages (
     content TEXT,
     ts INTEGER
 )
-""")
-
-q("""
+""",
+        """
 CREATE TABLE IF NOT EXISTS settings (
     key TEXT PRIMARY KEY,
     value TEXT
 )
-""")
+""",
+    ]),
+    # get_last_owner_for_sender, both halves of the admin search, latest users
+    (2, "hot path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_type_ts ON messages (sender_id, msg_type, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_ts ON messages (sender_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver_ts ON messages (receiver_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen DESC NULLS LAST)",
+    ], [
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_type_ts ON messages (sender_id, msg_type, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_ts ON messages (sender_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver_ts ON messages (receiver_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)",
+    ]),
+    (3, "broadcast jobs", [
+        """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id BIGSERIAL PRIMARY KEY,
+    admin_id BIGINT,
+    from_chat_id BIGINT,
+    message_id BIGINT,
+    status TEXT,
+    last_user_id BIGINT,
+    delivered INTEGER,
+    failed INTEGER,
+    total INTEGER,
+    status_message_id BIGINT,
+    created_at BIGINT,
+    updated_at BIGINT
+)
+""",
+        "CREATE INDEX IF NOT EXISTS idx_users_is_admin_user ON users (is_admin, user_id)",
+    ], [
+        """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_id INTEGER,
+    from_chat_id INTEGER,
+    message_id INTEGER,
+    status TEXT,
+    last_user_id INTEGER,
+    delivered INTEGER,
+    failed INTEGER,
+    total INTEGER,
+    status_message_id INTEGER,
+    created_at INTEGER,
+    updated_at INTEGER
+)
+""",
+        "CREATE INDEX IF NOT EXISTS idx_users_is_admin_user ON users (is_admin, user_id)",
+    ]),
+    # keyset pagination on (ts, id) for the admin search. SQLite secondary
+    # indexes already end with the rowid (= id), so only Postgres needs this.
+    (4, "search keyset indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_ts_id ON messages (sender_id, ts, id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver_ts_id ON messages (receiver_id, ts, id)",
+        "DROP INDEX IF EXISTS idx_messages_sender_ts",
+        "DROP INDEX IF EXISTS idx_messages_receiver_ts",
+    ], []),
+    (5, "blocks", [
+        """
+CREATE TABLE IF NOT EXISTS blocks (
+    owner_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    created_at BIGINT,
+    PRIMARY KEY (owner_id, user_id)
+)
+""",
+        "CREATE INDEX IF NOT EXISTS idx_blocks_created_at ON blocks (created_at)",
+    ], [
+        """
+CREATE TABLE IF NOT EXISTS blocks (
+    owner_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    created_at INTEGER,
+    PRIMARY KEY (owner_id, user_id)
+)
+""",
+        "CREATE INDEX IF NOT EXISTS idx_blocks_created_at ON blocks (created_at)",
+    ]),
+    (6, "conversation state", [
+        """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id BIGINT NOT NULL,
+    key TEXT NOT NULL,
+    value BIGINT,
+    updated_at BIGINT,
+    PRIMARY KEY (user_id, key)
+)
+""",
+    ], [
+        """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER,
+    updated_at INTEGER,
+    PRIMARY KEY (user_id, key)
+)
+""",
+    ]),
+    # see MESSAGE PARTITIONS. The existing table becomes messages_legacy and
+    # covers everything up to the next month boundary.
+    (7, "partitioned messages", [
+        """
+CREATE TABLE IF NOT EXISTS message_partitions (
+    name TEXT PRIMARY KEY,
+    lo BIGINT NOT NULL,
+    hi BIGINT NOT NULL,
+    archived_at BIGINT,
+    archive_path TEXT,
+    row_count BIGINT
+)
+""",
+        """
+DO $$
+DECLARE
+    bound BIGINT := extract(epoch FROM date_trunc('month', now() AT TIME ZONE 'UTC') + interval '1 month')::BIGINT;
+BEGIN
+    ALTER TABLE messages RENAME TO messages_legacy;
+    -- the sequence must outlive messages_legacy once that gets archived
+    ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+    CREATE TABLE messages (
+        id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+        sender_id BIGINT,
+        receiver_id BIGINT,
+        msg_type TEXT,
+        content TEXT,
+        ts BIGINT
+    ) PARTITION BY RANGE (ts);
+    CREATE INDEX idx_msgs_sender_type_ts ON messages (sender_id, msg_type, ts);
+    CREATE INDEX idx_msgs_sender_ts_id ON messages (sender_id, ts, id);
+    CREATE INDEX idx_msgs_receiver_ts_id ON messages (receiver_id, ts, id);
+    UPDATE messages_legacy SET ts = 0 WHERE ts IS NULL;
+    -- matches the partition bound, so ATTACH skips the validation scan
+    EXECUTE format('ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_ts CHECK (ts IS NOT NULL AND ts < %s)', bound);
+    EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%s)', bound);
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+    INSERT INTO message_partitions (name, lo, hi) VALUES ('messages_legacy', 0, bound);
+END $$
+""",
+    ], [
+        """
+CREATE TABLE IF NOT EXISTS message_partitions (
+    name TEXT PRIMARY KEY,
+    lo INTEGER NOT NULL,
+    hi INTEGER NOT NULL,
+    archived_at INTEGER,
+    archive_path TEXT,
+    row_count INTEGER
+)
+""",
+        "ALTER TABLE messages RENAME TO messages_legacy",
+        "CREATE TABLE message_seq (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "INSERT INTO message_seq (name, value) SELECT 'messages', MAX("
+        "COALESCE((SELECT seq FROM sqlite_sequence WHERE name='messages_legacy'), 0), "
+        "COALESCE((SELECT MAX(id) FROM messages_legacy), 0))",
+        "INSERT INTO message_partitions (name, lo, hi) VALUES "
+        "('messages_legacy', 0, CAST(strftime('%s', 'now', 'start of month', '+1 month') AS INTEGER))",
+        "CREATE VIEW messages AS SELECT id, sender_id, receiver_id, msg_type, content, ts FROM messages_legacy",
+    ]),
+    # see STATS; backfilled from the existing rows (per-day new users can't be
+    # recovered, today's active users can)
+    (8, "stats counters", [
+        "CREATE TABLE IF NOT EXISTS stats_totals (key TEXT PRIMARY KEY, value BIGINT NOT NULL)",
+        """
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BIGINT NOT NULL,
+    PRIMARY KEY (day, key)
+)
+""",
+        "INSERT INTO stats_totals (key, value) SELECT 'users', COUNT(*) FROM users",
+        "INSERT INTO stats_totals (key, value) SELECT 'messages', COUNT(*) FROM messages",
+        "INSERT INTO stats_totals (key, value) "
+        "SELECT 'messages:' || COALESCE(msg_type, ''), COUNT(*) FROM messages GROUP BY msg_type",
+        "INSERT INTO stats_daily (day, key, value) "
+        "SELECT to_char(to_timestamp(ts) AT TIME ZONE 'UTC', 'YYYY-MM-DD'), 'messages', COUNT(*) "
+        "FROM messages WHERE ts IS NOT NULL GROUP BY 1",
+        "INSERT INTO stats_daily (day, key, value) "
+        "SELECT to_char(to_timestamp(ts) AT TIME ZONE 'UTC', 'YYYY-MM-DD'), 'messages:' || COALESCE(msg_type, ''), COUNT(*) "
+        "FROM messages WHERE ts IS NOT NULL GROUP BY 1, 2",
+        "INSERT INTO stats_daily (day, key, value) "
+        "SELECT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD'), 'active_users', COUNT(*) FROM users "
+        "WHERE last_seen >= extract(epoch FROM date_trunc('day', now() AT TIME ZONE 'UTC'))::BIGINT",
+    ], [
+        "CREATE TABLE IF NOT EXISTS stats_totals (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        """
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (day, key)
+)
+""",
+        "INSERT INTO stats_totals (key, value) SELECT 'users', COUNT(*) FROM users",
+        "INSERT INTO stats_totals (key, value) SELECT 'messages', COUNT(*) FROM messages",
+        "INSERT INTO stats_totals (key, value) "
+        "SELECT 'messages:' || COALESCE(msg_type, ''), COUNT(*) FROM messages GROUP BY msg_type",
+        "INSERT INTO stats_daily (day, key, value) "
+        "SELECT date(ts, 'unixepoch'), 'messages', COUNT(*) FROM messages WHERE ts IS NOT NULL GROUP BY 1",
+        "INSERT INTO stats_daily (day, key, value) "
+        "SELECT date(ts, 'unixepoch'), 'messages:' || COALESCE(msg_type, ''), COUNT(*) "
+        "FROM messages WHERE ts IS NOT NULL GROUP BY 1, 2",
+        "INSERT INTO stats_daily (day, key, value) "
+        "SELECT date('now'), 'active_users', COUNT(*) FROM users "
+        "WHERE last_seen >= CAST(strftime('%s', date('now')) AS INTEGER)",
+    ]),
+    # the separate pending-mode keys become one packed "conv" key (see STATES);
+    # a user holding several keeps the one that used to take precedence
+    (9, "single conversation mode", CONV_MIGRATION, CONV_MIGRATION),
+    # see FULL-TEXT SEARCH. Postgres: a generated tsvector column (inherited
+    # by every partition) with a GIN index. SQLite: an FTS5 table keyed by
+    # message id, filled by write_message_rows().
+    (10, "full-text search", [
+        "CREATE OR REPLACE FUNCTION fts_normalize(t TEXT) RETURNS TEXT "
+        f"LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ SELECT lower(translate(t, '{FTS_FROM}{FTS_DROP_CHARS}', '{FTS_TO}')) $$",
+        "ALTER TABLE messages ADD COLUMN content_tsv tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, fts_normalize(coalesce(content, '')))) STORED",
+        "CREATE INDEX idx_msgs_fts ON messages USING GIN (content_tsv)",
+    ], [
+        "CREATE VIRTUAL TABLE messages_fts USING fts5(content, tokenize='unicode61')",
+        "INSERT INTO messages_fts (rowid, content) "
+        "SELECT id, fts_normalize(content) FROM messages WHERE content IS NOT NULL AND content <> ''",
+    ]),
+]
+
+
+async def run_migrations():
+    await q(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name TEXT, applied_at BIGINT)"
+    )
+    for version, name, pg_steps, sqlite_steps in MIGRATIONS:
+        t0 = time.monotonic()
+        if await apply_migration(version, name, pg_steps if USING_PG else sqlite_steps):
+            print(f"migration {version} ({name}) applied in {time.monotonic() - t0:.2f}s")
+
+
+async def seed_settings():
+    if get_setting("force_join_channel", "") == "":
+        await set_setting("force_join_channel", "@YOUR_CHANNEL")
+    if get_setting("force_join_link", "") == "":
+        await set_setting("force_join_link", "https://t.me/YOUR_CHANNEL")
+    if get_setting("force_join_enabled", "") == "":
+        await set_bool_setting("force_join_enabled", False)
 
 
 # ---------- settings helpers ----------
-def set_setting(key: str, value: str):
+# The whole settings table is held in memory: loaded at startup, updated
+# write-through by set_setting(), so reads (must_join runs on every update)
+# never touch the DB. With several processes sharing one DB set SETTINGS_TTL
+# (seconds) to periodically reload changes made by the other instances.
+SETTINGS_TTL = env_float("SETTINGS_TTL", 0.0)
+
+settings_cache = {}  # key -> value
+
+
+def on_setting_changed(key: str):
+    if key == "force_join_channel":
+        membership_cache.clear()
+
+
+async def load_settings():
+    rows = await q_all("SELECT key, value FROM settings")
+    fresh = {k: v for k, v in rows}
+    changed = [k for k in fresh.keys() | settings_cache.keys() if fresh.get(k) != settings_cache.get(k)]
+    settings_cache.clear()
+    settings_cache.update(fresh)
+    for k in changed:
+        on_setting_changed(k)
+
+
+async def settings_refresher():
+    while True:
+        await asyncio.sleep(SETTINGS_TTL)
+        try:
+            await load_settings()
+        except Exception as e:
+            print("settings refresh failed:", repr(e))
+
+
+async def set_setting(key: str, value: str):
     if USING_PG:
-        q(
+        await q(
             "INSERT INTO settings(key,value) VALUES(%s,%s) "
             "ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value",
             (key, value)
         )
     else:
-        q(
+        await q(
             "INSERT INTO settings(key,value) VALUES(?,?) "
             "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
             (key, value)
         )
+    old = settings_cache.get(key)
+    settings_cache[key] = value
+    if old != value:
+        on_setting_changed(key)
 
 def get_setting(key: str, default: str = "") -> str:
-    if USING_PG:
-        q("SELECT value FROM settings WHERE key=%s", (key,))
-    else:
-        q("SELECT value FROM settings WHERE key=?", (key,))
-    row = cur.fetchone()
-    return row[0] if row and row[0] is not None else default
+    v = settings_cache.get(key)
+    return v if v is not None else default
 
 def get_bool_setting(key: str, default: bool = False) -> bool:
     v = get_setting(key, "1" if default else "0")
     return v == "1"
 
-def set_bool_setting(key: str, value: bool):
-    set_setting(key, "1" if value else "0")
+async def set_bool_setting(key: str, value: bool):
+    await set_setting(key, "1" if value else "0")
 
 
-# defaults
-if get_setting("force_join_channel", "") == "":
-    set_setting("force_join_channel", "@YOUR_CHANNEL")
-if get_setting("force_join_link", "") == "":
-    set_setting("force_join_link", "https://t.me/YOUR_CHANNEL")
-if get_setting("force_join_enabled", "") == "":
-    set_bool_setting("force_join_enabled", False)
+# ---------- MESSAGE PARTITIONS ----------
+# messages is split by calendar month (UTC) of ts. Postgres: a partitioned
+# table with one partition per month, messages_legacy (the table from before
+# partitioning) and a DEFAULT partition for stray rows. SQLite: one table per
+# month under a `messages` view; ids are handed out from message_seq so they
+# stay unique across tables. message_partitions is the catalog for both.
+#
+# maintain_partitions() creates this month's and next month's partition ahead
+# of time, and the message log writer creates any that is still missing before
+# writing into it (on both backends). On Postgres, rows that landed in the
+# DEFAULT partition anyway (e.g. from an older version) are moved out when
+# their month's partition is created: a new partition can't be attached while
+# DEFAULT holds rows in its range. With MSG_RETENTION_DAYS > 0, partitions that ended longer ago than
+# that are written to MSG_ARCHIVE_DIR as gzip'd JSONL and dropped; the admin
+# search keeps reading them from there. Hot-path lookups (last owner / last
+# reply target) only look MSG_HOT_DAYS back, i.e. at the newest partitions.
+MSG_RETENTION_DAYS = env_int("MSG_RETENTION_DAYS", 0)  # 0: never archive
+MSG_HOT_DAYS = env_int("MSG_HOT_DAYS", 60)
+MSG_ARCHIVE_DIR = os.environ.get("MSG_ARCHIVE_DIR", "archive")
+MSG_MAINTENANCE_INTERVAL = env_float("MSG_MAINTENANCE_INTERVAL", 3600.0)
+MSG_COLUMNS = "id, sender_id, receiver_id, msg_type, content, ts"
 
+partitions = []  # (lo, hi, name) of partitions still in the DB, by lo
+archives = []    # (lo, hi, name, path) of archived partitions, by lo
 
-# ---------- data helpers ----------
-def save_user(user):
-    full_name = (user.full_name or "").strip()
-    username = (user.username or "").strip() if user.username else None
-    is_admin = int(user.id in ADMIN_IDS)
-    ts = now_ts()
 
+def month_bounds(ts: int) -> tuple[str, int, int]:
+    """(partition name, start, end) of the UTC month containing ts."""
+    d = datetime.fromtimestamp(ts, timezone.utc)
+    start = datetime(d.year, d.month, 1, tzinfo=timezone.utc)
+    end = datetime(d.year + d.month // 12, d.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return f"messages_p{d.year:04d}{d.month:02d}", int(start.timestamp()), int(end.timestamp())
+
+
+async def load_partitions():
+    rows = await q_all("SELECT name, lo, hi, archive_path FROM message_partitions ORDER BY lo")
+    partitions[:] = [(lo, hi, name) for name, lo, hi, path in rows if not path]
+    archives[:] = [(lo, hi, name, path) for name, lo, hi, path in rows if path]
+
+
+def partition_for(ts: int) -> str | None:
+    i = bisect_left(partitions, (ts + 1,)) - 1
+    if i >= 0 and partitions[i][0] <= ts < partitions[i][1]:
+        return partitions[i][2]
+    return None
+
+
+def messages_view_sql(names) -> str:
+    return "CREATE VIEW messages AS " + " UNION ALL ".join(f"SELECT {MSG_COLUMNS} FROM {n}" for n in names)
+
+
+async def ensure_partition(ts: int) -> str:
+    name = partition_for(ts)
+    if name:
+        return name
+    name, lo, hi = month_bounds(ts)
     if USING_PG:
-        q("""
-            INSERT INTO users (user_id, username, full_name, is_admin, last_seen)
-            VALUES (%s,%s,%s,%s,%s)
-            ON CONFLICT(user_id) DO UPDATE SET
-              username=EXCLUDED.username,
-              full_name=EXCLUDED.full_name,
-              is_admin=EXCLUDED.is_admin,
-              last_seen=EXCLUDED.last_seen
-        """, (user.id, username, full_name, is_admin, ts))
+        create = (f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages FOR VALUES FROM ({lo}) TO ({hi})", None)
+        steps = [
+            create,
+            ("INSERT INTO message_partitions (name, lo, hi) VALUES (%s,%s,%s) ON CONFLICT (name) DO NOTHING",
+             (name, lo, hi)),
+        ]
+        if await q_one("SELECT 1 FROM messages_default WHERE ts >= %s AND ts < %s LIMIT 1", (lo, hi)):
+            # the CREATE would fail while DEFAULT holds rows of this month
+            steps[:1] = [
+                ("ALTER TABLE messages DETACH PARTITION messages_default", None),
+                create,
+                (f"INSERT INTO {name} ({MSG_COLUMNS}) SELECT {MSG_COLUMNS} FROM messages_default "
+                 "WHERE ts >= %s AND ts < %s", (lo, hi)),
+                ("DELETE FROM messages_default WHERE ts >= %s AND ts < %s", (lo, hi)),
+                ("ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT", None),
+            ]
+        await q_tx(steps)
     else:
-        q("""
-            INSERT INTO users (user_id, username, full_name, is_admin, last_seen)
-            VALUES (?,?,?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              username=excluded.username,
-              full_name=excluded.full_name,
-              is_admin=excluded.is_admin,
-              last_seen=excluded.last_seen
-        """, (user.id, username, full_name, is_admin, ts))
-
-
-def save_message(sender, receiver, msg_type, content=None):
-    ts = now_ts()
+        names = sorted([(p_lo, p_name) for p_lo, _, p_name in partitions] + [(lo, name)])
+        await q_tx([
+            (f"CREATE TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY, sender_id INTEGER, "
+             "receiver_id INTEGER, msg_type TEXT, content TEXT, ts INTEGER)", None),
+            (f"CREATE INDEX IF NOT EXISTS idx_{name}_sender_type_ts ON {name} (sender_id, msg_type, ts)", None),
+            (f"CREATE INDEX IF NOT EXISTS idx_{name}_sender_ts ON {name} (sender_id, ts)", None),
+            (f"CREATE INDEX IF NOT EXISTS idx_{name}_receiver_ts ON {name} (receiver_id, ts)", None),
+            ("INSERT OR IGNORE INTO message_partitions (name, lo, hi) VALUES (?,?,?)", (name, lo, hi)),
+            ("DROP VIEW IF EXISTS messages", None),
+            (messages_view_sql(n for _, n in names), None),
+        ])
+    await load_partitions()
+    return name
+
+
+def _write_archive(path: str, lines):
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+async def archive_partition(lo: int, hi: int, name: str):
+    os.makedirs(MSG_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(MSG_ARCHIVE_DIR, f"{name}.jsonl.gz")
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    count = 0
+    # rows in (ts, id) order, so archives can be read back in search order
+    async with aclosing(q_stream(f"SELECT {MSG_COLUMNS} FROM {name} ORDER BY ts, id")) as chunks:
+        async for rows in chunks:
+            lines = [json.dumps(list(r), ensure_ascii=False) + "\n" for r in rows]
+            await asyncio.to_thread(_write_archive, tmp, lines)
+            count += len(rows)
+    if count == 0:
+        await asyncio.to_thread(_write_archive, tmp, [])
+    os.replace(tmp, path)
+
     if USING_PG:
-        q(
-            "INSERT INTO messages (sender_id, receiver_id, msg_type, content, ts) VALUES (%s,%s,%s,%s,%s)",
-            (sender, receiver, msg_type, content, ts)
-        )
+        await q_tx([
+            (f"ALTER TABLE messages DETACH PARTITION {name}", None),
+            (f"DROP TABLE {name}", None),
+            ("UPDATE message_partitions SET archived_at=%s, archive_path=%s, row_count=%s WHERE name=%s",
+             (now_ts(), path, count, name)),
+        ])
     else:
-        q(
-            "INSERT INTO messages (sender_id, receiver_id, msg_type, content, ts) VALUES (?,?,?,?,?)",
-            (sender, receiver, msg_type, content, ts)
-        )
+        await q_tx([
+            ("DROP VIEW IF EXISTS messages", None),
+            (messages_view_sql(n for _, _, n in partitions if n != name), None),
+            (f"DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM {name})", None),
+            (f"DROP TABLE {name}", None),
+            ("UPDATE message_partitions SET archived_at=?, archive_path=?, row_count=? WHERE name=?",
+             (now_ts(), path, count, name)),
+        ])
+    await load_partitions()
+    print(f"archived {name}: {count} rows -> {path}")
 
 
-def extract_content(update: Update) -> str:
-    m = update.message
-    if not m:
-        return ""
-    if m.text:
-        return m.text
-    if m.caption:
-        return m.caption
-    if m.photo:
-        return "[photo]"
-    if m.video:
-        return "[video]"
-    if m.document:
-        return "[document]"
-    if m.voice:
-        return "[voice]"
-    if m.audio:
-        return "[audio]"
-    if m.sticker:
-        return "[sticker]"
-    return "[other]"
+async def maintain_partitions():
+    now = now_ts()
+    await ensure_partition(now)
+    await ensure_partition(month_bounds(now)[2])  # next month, before it starts
+    if MSG_RETENTION_DAYS > 0:
+        cutoff = now - MSG_RETENTION_DAYS * 86400
+        for lo, hi, name in list(partitions):
+            if hi <= cutoff:
+                await archive_partition(lo, hi, name)
 
 
-# ---------- FORCE JOIN CHECK ----------
-async def must_join(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    if update.effective_user and update.effective_user.id in ADMIN_IDS:
-        return True
+async def partition_maintainer():
+    # first pass right away, but off the startup path: archiving can take a while
+    while True:
+        try:
+            await maintain_partitions()
+        except Exception as e:
+            print("partition maintenance failed:", repr(e))
+        await asyncio.sleep(MSG_MAINTENANCE_INTERVAL)
 
-    enabled = get_bool_setting("force_join_enabled", False)
-    if not enabled:
-        return True
 
-    channel = get_setting("force_join_channel", "@YOUR_CHANNEL")
-    link = get_setting("force_join_link", "https://t.me/YOUR_CHANNEL")
+# archived rows of one user, per archive file; admins page through the same
+# user repeatedly, so a few recent scans are kept
+ARCHIVE_CACHE_SIZE = 32
+archive_cache = OrderedDict()  # (path, user_id) -> [row, ...] in (ts, id) order
 
-    try:
-        member = await context.bot.get_chat_member(channel, update.effective_user.id)
-        if member.status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
-            return True
-    except Exception:
-        pass
 
-    text = f"برای استفاده از ربات اول باید عضو کانال بشی:\n{link}"
-    if update.message:
-        await update.message.reply_text(text)
-    elif update.callback_query:
-        await update.callback_query.message.reply_text(text)
-    return False
+def _scan_archive(path: str, user_id: int):
+    out = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            r = json.loads(line)
+            if r[1] == user_id or r[2] == user_id:
+                out.append(tuple(r))
+    return out
 
 
-# ---------- helper: find last owner from DB (for reply/block permissions + send_again) ----------
-def get_last_owner_for_sender(sender_id: int) -> int | None:
+async def archived_rows(path: str, user_id: int):
+    key = (path, user_id)
+    rows = archive_cache.get(key)
+    if rows is None:
+        rows = await asyncio.to_thread(_scan_archive, path, user_id)
+        archive_cache[key] = rows
+        if len(archive_cache) > ARCHIVE_CACHE_SIZE:
+            archive_cache.popitem(last=False)
+    else:
+        archive_cache.move_to_end(key)
+    return rows
+
+
+async def fetch_archived_search_rows(target: int, direction: str, cur_ts: int, cur_id: int, limit: int):
+    """Same contract as fetch_search_rows, over the archive files."""
+    out = []
+    if direction == "o":
+        for lo, hi, name, path in reversed(archives):
+            if lo > cur_ts:
+                continue
+            rows = [r for r in await archived_rows(path, target) if (r[5], r[0]) < (cur_ts, cur_id)]
+            out.extend(reversed(rows))
+            if len(out) >= limit:
+                break
+    else:
+        for lo, hi, name, path in archives:
+            if hi <= cur_ts:
+                continue
+            rows = [r for r in await archived_rows(path, target) if (r[5], r[0]) > (cur_ts, cur_id)]
+            out.extend(rows)
+            if len(out) >= limit:
+                break
+    return out[:limit]
+
+
+# ---------- STATS ----------
+# Counters kept up to date as rows are written, so the admin panel never
+# scans users/messages. stats_totals holds running totals ("users",
+# "messages", "messages:<type>"), stats_daily the same per UTC day plus
+# "new_users" and "active_users". The user flush counts a user as new when
+# they weren't in the table yet and as active once per day (the write-behind
+# always writes a user's first touch of a day). Message counts are added
+# after each message log batch lands.
+if USING_PG:
+    BUMP_TOTAL_SQL = (
+        "INSERT INTO stats_totals (key, value) VALUES (%s,%s) "
+        "ON CONFLICT (key) DO UPDATE SET value = stats_totals.value + EXCLUDED.value"
+    )
+    BUMP_DAILY_SQL = (
+        "INSERT INTO stats_daily (day, key, value) VALUES (%s,%s,%s) "
+        "ON CONFLICT (day, key) DO UPDATE SET value = stats_daily.value + EXCLUDED.value"
+    )
+else:
+    BUMP_TOTAL_SQL = (
+        "INSERT INTO stats_totals (key, value) VALUES (?,?) "
+        "ON CONFLICT (key) DO UPDATE SET value = stats_totals.value + excluded.value"
+    )
+    BUMP_DAILY_SQL = (
+        "INSERT INTO stats_daily (day, key, value) VALUES (?,?,?) "
+        "ON CONFLICT (day, key) DO UPDATE SET value = stats_daily.value + excluded.value"
+    )
+
+
+def stats_day(ts: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+async def bump_stats(totals: dict, daily: dict):
+    """Adds {key: n} to stats_totals and {(day, key): n} to stats_daily."""
     try:
+        await q_many(BUMP_TOTAL_SQL, [(k, n) for k, n in totals.items() if n])
+        await q_many(BUMP_DAILY_SQL, [(day, k, n) for (day, k), n in daily.items() if n])
+    except Exception as e:
+        # counters are best effort; the rows they describe are already stored
+        print("stats update failed:", repr(e))
+
+
+async def record_message_stats(rows):
+    totals, daily = {}, {}
+    for _sender, _receiver, msg_type, _content, ts in rows:
+        day = stats_day(ts)
+        for key in ("messages", f"messages:{msg_type or ''}"):
+            totals[key] = totals.get(key, 0) + 1
+            daily[(day, key)] = daily.get((day, key), 0) + 1
+    await bump_stats(totals, daily)
+
+
+async def record_user_stats(rows, prev_seen: dict):
+    """rows: flushed users rows; prev_seen: user_id -> last_seen before the flush (absent = new user)."""
+    totals, daily = {}, {}
+    for user_id, _username, _full_name, _is_admin, ts in rows:
+        day = stats_day(ts)
+        prev = prev_seen.get(user_id)
+        if user_id not in prev_seen:
+            totals["users"] = totals.get("users", 0) + 1
+            daily[(day, "new_users")] = daily.get((day, "new_users"), 0) + 1
+        if prev is None or prev // 86400 != ts // 86400:
+            daily[(day, "active_users")] = daily.get((day, "active_users"), 0) + 1
+    await bump_stats(totals, daily)
+
+
+async def fetch_last_seen(user_ids) -> dict:
+    out = {}
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
         if USING_PG:
-            q(
-                "SELECT receiver_id FROM messages WHERE sender_id=%s AND msg_type=%s ORDER BY ts DESC LIMIT 1",
-                (sender_id, "forward")
-            )
+            rows = await q_all("SELECT user_id, last_seen FROM users WHERE user_id = ANY(%s)", (chunk,))
         else:
-            q(
-                "SELECT receiver_id FROM messages WHERE sender_id=? AND msg_type=? ORDER BY ts DESC LIMIT 1",
-                (sender_id, "forward")
-            )
-        row = cur.fetchone()
-        return int(row[0]) if row else None
-    except Exception:
-        return None
+            marks = ",".join("?" * len(chunk))
+            rows = await q_all(f"SELECT user_id, last_seen FROM users WHERE user_id IN ({marks})", chunk)
+        out.update({uid: seen for uid, seen in rows})
+    return out
 
 
-# ---------- STATES ----------
-user_links = {}        # user_id -> owner_id (active link mode)
-reply_state = {}       # replier_id -> target_sender_id
-blocked = {}           # owner_id -> set(user_ids)
-send_direct_state = set()
+async def stats_summary(days: int = 7):
+    """(totals, {day: {key: n}}) for the last `days` days; two small reads."""
+    totals = dict(await q_all("SELECT key, value FROM stats_totals"))
+    since = stats_day(now_ts() - (days - 1) * 86400)
+    if USING_PG:
+        rows = await q_all("SELECT day, key, value FROM stats_daily WHERE day >= %s", (since,))
+    else:
+        rows = await q_all("SELECT day, key, value FROM stats_daily WHERE day >= ?", (since,))
+    daily = {}
+    for day, key, value in rows:
+        daily.setdefault(day, {})[key] = value
+    return totals, daily
 
-admin_search_state = set()
-admin_broadcast_state = set()
-admin_set_channel_state = set()
-admin_set_link_state = set()
 
-# admin anonymous send
-admin_anon_target_state = set()
-admin_anon_message_state = {}  # admin_id -> target_user_id
+# ---------- data helpers ----------
+# users rows are written behind: save_user() only records the latest profile
+# in memory, and a background flush upserts all dirty rows in one batch every
+# USER_FLUSH_INTERVAL seconds. A user whose username/full_name didn't change
+# is only re-written once their last_seen is USER_SEEN_WINDOW seconds stale
+# or on their first touch of a new (UTC) day, which the DAU counter relies on.
+# What was last written is remembered for at most USER_CACHE_MAX users and
+# only until the day changes (older entries can't skip a write anyway); a
+# user who fell out just costs one extra upsert.
+USER_SEEN_WINDOW = env_float("USER_SEEN_WINDOW", 300.0)
+USER_FLUSH_INTERVAL = env_float("USER_FLUSH_INTERVAL", 5.0)
+USER_CACHE_MAX = env_int("USER_CACHE_MAX", 200000)
 
-# ✅ for fixing send_again + permissions
-last_owner_map = {}              # sender_id -> owner_id (memory quick path)
-last_link_owner_for_user = {}    # user_id -> owner_id (for send_again after link usage)
-last_reply_target_for_owner = {} # owner_id -> target_sender_id (for send_again after reply)
+if USING_PG:
+    UPSERT_USERS_SQL = """
+        INSERT INTO users (user_id, username, full_name, is_admin, last_seen)
+        VALUES (%s,%s,%s,%s,%s)
+        ON CONFLICT(user_id) DO UPDATE SET
+          username=EXCLUDED.username,
+          full_name=EXCLUDED.full_name,
+          is_admin=EXCLUDED.is_admin,
+          last_seen=EXCLUDED.last_seen
+    """
+else:
+    UPSERT_USERS_SQL = """
+        INSERT INTO users (user_id, username, full_name, is_admin, last_seen)
+        VALUES (?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          username=excluded.username,
+          full_name=excluded.full_name,
+          is_admin=excluded.is_admin,
+          last_seen=excluded.last_seen
+    """
 
 
-# ---------- MENUS ----------
-def main_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📎 دریافت لینک اختصاصی", callback_data="get_link")],
-        [InlineKeyboardButton("✉️ ارسال پیام مستقیم", callback_data="send_direct")]
-    ])
+class UserDirectory:
+    def __init__(self, seen_window: float, max_cached: int):
+        self.seen_window = seen_window
+        self.max_cached = max(1, max_cached)
+        # user_id -> (username, full_name, is_admin, last_seen) as last written, oldest write first
+        self._persisted = OrderedDict()
+        self._dirty = {}      # user_id -> (user_id, username, full_name, is_admin, last_seen)
+        self._flush_lock = asyncio.Lock()
+        self.skipped = 0
+        self.written = 0
 
-def admin_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("👥 آمار کاربران", callback_data="admin_stats")],
-        [InlineKeyboardButton("🆕 ۱۵ کاربر آخر", callback_data="admin_latest_users")],
-        [InlineKeyboardButton("🔍 مشاهده پیام‌های کاربر (با محتوا)", callback_data="admin_search")],
-        [InlineKeyboardButton("✉️ پیام ناشناس به کاربر", callback_data="admin_anon_send")],
+    def touch(self, user_id: int, username, full_name, is_admin: int, ts: int):
+        row = (user_id, username, full_name, is_admin, ts)
+        if user_id in self._dirty:
+            self._dirty[user_id] = row
+            return
+        prev = self._persisted.get(user_id)
+        if (prev is not None and prev[:3] == row[1:4] and ts - prev[3] < self.seen_window
+                and ts // 86400 == prev[3] // 86400):
+            self.skipped += 1
+            return
+        self._dirty[user_id] = row
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def cached(self) -> int:
+        return len(self._persisted)
+
+    def _trim(self):
+        day = now_ts() // 86400
+        while self._persisted:
+            user_id, prev = next(iter(self._persisted.items()))
+            if len(self._persisted) <= self.max_cached and prev[3] // 86400 >= day:
+                break
+            del self._persisted[user_id]
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            rows = list(self._dirty.values())
+            self._dirty.clear()
+            try:
+                prev_seen = {row[0]: self._persisted[row[0]][3] for row in rows if row[0] in self._persisted}
+                prev_seen.update(await fetch_last_seen([row[0] for row in rows if row[0] not in prev_seen]))
+                await q_many(UPSERT_USERS_SQL, rows)
+            except Exception:
+                # put them back unless a newer touch arrived meanwhile
+                for row in rows:
+                    self._dirty.setdefault(row[0], row)
+                raise
+            for row in rows:
+                self._persisted[row[0]] = row[1:]
+                self._persisted.move_to_end(row[0])
+            self._trim()
+            self.written += len(rows)
+        await record_user_stats(rows, prev_seen)
+
+
+user_directory = UserDirectory(USER_SEEN_WINDOW, USER_CACHE_MAX)
+
+
+async def user_flusher():
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        try:
+            await user_directory.flush()
+        except Exception as e:
+            print("user flush failed:", repr(e))
+
+
+def save_user(user):
+    full_name = (user.full_name or "").strip()
+    username = (user.username or "").strip() if user.username else None
+    is_admin = int(user.id in ADMIN_IDS)
+    user_directory.touch(user.id, username, full_name, is_admin, now_ts())
+
+
+# messages rows go through a bounded queue drained by a single writer task:
+# rows are inserted in batches of up to MSGLOG_BATCH, at the latest
+# MSGLOG_FLUSH_INTERVAL seconds after the first queued row. When the queue
+# (MSGLOG_QUEUE_MAX) is full save_message() waits, which throttles senders
+# instead of dropping log rows. A failed batch is retried with backoff (up to
+# MSGLOG_RETRY_MAX seconds apart) until it's written, so an outage fills the
+# queue instead of losing rows. stop() drains everything still queued; only
+# there is a batch given up after MSGLOG_RETRIES attempts.
+MSGLOG_QUEUE_MAX = env_int("MSGLOG_QUEUE_MAX", 10000)
+MSGLOG_BATCH = env_int("MSGLOG_BATCH", 200)
+MSGLOG_FLUSH_INTERVAL = env_float("MSGLOG_FLUSH_INTERVAL", 0.5)
+MSGLOG_RETRY_MAX = env_float("MSGLOG_RETRY_MAX", 30.0)
+MSGLOG_RETRIES = 3
+
+
+async def write_message_rows(rows):
+    if USING_PG:
+        # the month's partition must exist first, or rows would land in DEFAULT
+        for row in rows:
+            if partition_for(row[4]) is None:
+                await ensure_partition(row[4])
+        # one multi-row INSERT per batch
+        values = ",".join(["(%s,%s,%s,%s,%s)"] * len(rows))
+        params = [v for row in rows for v in row]
+        await q(
+            f"INSERT INTO messages (sender_id, receiver_id, msg_type, content, ts) VALUES {values}",
+            params
+        )
+    else:
+        # rows go straight into their month's table (the view isn't insertable).
+        # Ids are reserved from message_seq in the same transaction as the
+        # rows and their full-text entries, so a failed batch leaves nothing
+        # behind and its retry can't duplicate rows.
+        tables = [partition_for(row[4]) or await ensure_partition(row[4]) for row in rows]
+        steps = [("UPDATE message_seq SET value = value + ? WHERE name='messages'", (len(rows),))]
+        new_id = "(SELECT value FROM message_seq WHERE name='messages') - ?"
+        for i, (table, row) in enumerate(zip(tables, rows)):
+            back = len(rows) - 1 - i
+            steps.append((
+                f"INSERT INTO {table} (id, sender_id, receiver_id, msg_type, content, ts) "
+                f"VALUES ({new_id},?,?,?,?,?)",
+                (back, *row)
+            ))
+            if row[3]:
+                steps.append((f"INSERT INTO messages_fts (rowid, content) VALUES ({new_id}, fts_normalize(?))",
+                              (back, row[3])))
+        await q_tx(steps)
+
+
+class MessageLogWriter:
+    _STOP = object()
+
+    def __init__(self, max_queue: int, batch_size: int, interval: float):
+        self.max_queue = max_queue
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.queue = None
+        self._full = None
+        self._task = None
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._full = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def pending(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def put(self, row):
+        if self._task is None:
+            # writer not running (startup/shutdown): write directly
+            await write_message_rows([row])
+            return
+        await self.queue.put(row)
+        if self.queue.qsize() >= self.batch_size:
+            self._full.set()
+
+    async def flush(self):
+        # wait until everything queued so far is written
+        if self._task is None:
+            return
+        self._full.set()
+        await self.queue.join()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        await self.queue.put(self._STOP)
+        self._full.set()
+        await task
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            if first is not self._STOP and self.queue.qsize() < self.batch_size - 1 and self.interval > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+
+            batch = []
+            taken = 1
+            stopping = first is self._STOP
+            if not stopping:
+                batch.append(first)
+            while not stopping and len(batch) < self.batch_size:
+                try:
+                    row = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                taken += 1
+                if row is self._STOP:
+                    stopping = True
+                else:
+                    batch.append(row)
+
+            if batch:
+                await self._write(batch)
+            for _ in range(taken):
+                self.queue.task_done()
+            if stopping:
+                # drain anything queued behind the stop marker
+                rest = []
+                while not self.queue.empty():
+                    row = self.queue.get_nowait()
+                    if row is not self._STOP:
+                        rest.append(row)
+                for i in range(0, len(rest), self.batch_size):
+                    await self._write(rest[i:i + self.batch_size])
+                return
+
+    async def _write(self, batch):
+        attempt = 0
+        while True:
+            try:
+                await write_message_rows(batch)
+                break
+            except Exception as e:
+                attempt += 1
+                print(f"message log write failed (attempt {attempt}):", repr(e))
+                if self._task is None and attempt >= MSGLOG_RETRIES:
+                    # stopping: don't hold shutdown up forever
+                    self.dropped += len(batch)
+                    return
+                await asyncio.sleep(min(MSGLOG_RETRY_MAX, 0.5 * 2 ** (attempt - 1)))
+        self.written += len(batch)
+        try:
+            await record_message_stats(batch)
+        except Exception as e:
+            print("message stats update failed:", repr(e))
+
+
+message_log = MessageLogWriter(MSGLOG_QUEUE_MAX, MSGLOG_BATCH, MSGLOG_FLUSH_INTERVAL)
+
+
+async def save_message(sender, receiver, msg_type, content=None):
+    await message_log.put((sender, receiver, msg_type, content, now_ts()))
+
+
+def extract_content(update: Update) -> str:
+    m = update.message
+    if not m:
+        return ""
+    if m.text:
+        return m.text
+    if m.caption:
+        return m.caption
+    if m.photo:
+        return "[photo]"
+    if m.video:
+        return "[video]"
+    if m.document:
+        return "[document]"
+    if m.voice:
+        return "[voice]"
+    if m.audio:
+        return "[audio]"
+    if m.sticker:
+        return "[sticker]"
+    return "[other]"
+
+
+# ---------- FORCE JOIN CHECK ----------
+# get_chat_member results cached per (channel, user_id): members for
+# MEMBER_CACHE_TTL seconds, non-members for the shorter MEMBER_CACHE_NEG_TTL
+# (so a user who just joined isn't locked out for long). LRU-bounded to
+# MEMBER_CACHE_MAX entries and cleared when force_join_channel changes.
+MEMBER_CACHE_TTL = env_float("MEMBER_CACHE_TTL", 600.0)
+MEMBER_CACHE_NEG_TTL = env_float("MEMBER_CACHE_NEG_TTL", 30.0)
+MEMBER_CACHE_MAX = env_int("MEMBER_CACHE_MAX", 50000)
+
+
+class MembershipCache:
+    def __init__(self, ttl: float, neg_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # (channel, user_id) -> (is_member, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, channel: str, user_id: int) -> bool | None:
+        key = (channel, user_id)
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return is_member
+
+    def put(self, channel: str, user_id: int, is_member: bool):
+        ttl = self.ttl if is_member else self.neg_ttl
+        if ttl <= 0:
+            return
+        key = (channel, user_id)
+        self._data[key] = (is_member, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / total) if total else 0.0,
+        }
+
+
+membership_cache = MembershipCache(MEMBER_CACHE_TTL, MEMBER_CACHE_NEG_TTL, MEMBER_CACHE_MAX)
+
+
+async def is_channel_member(bot, channel: str, user_id: int) -> bool:
+    cached = membership_cache.get(channel, user_id)
+    if cached is not None:
+        return cached
+    try:
+        member = await bot.get_chat_member(channel, user_id)
+    except Exception:
+        # API/permission errors aren't cached: retry on the next update
+        return False
+    ok = member.status in (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+    membership_cache.put(channel, user_id, ok)
+    return ok
+
+
+async def must_join(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    if update.effective_user and update.effective_user.id in ADMIN_IDS:
+        return True
+
+    enabled = get_bool_setting("force_join_enabled", False)
+    if not enabled:
+        return True
+
+    channel = get_setting("force_join_channel", "@YOUR_CHANNEL")
+    link = get_setting("force_join_link", "https://t.me/YOUR_CHANNEL")
+
+    if await is_channel_member(context.bot, channel, update.effective_user.id):
+        return True
+
+    text = f"برای استفاده از ربات اول باید عضو کانال بشی:\n{link}"
+    if update.message:
+        await update.message.reply_text(text)
+    elif update.callback_query:
+        await update.callback_query.message.reply_text(text)
+    return False
+
+
+# ---------- helper: find last owner from DB (for reply/block permissions + send_again) ----------
+async def get_last_receiver(sender_id: int, msg_type: str) -> int | None:
+    # only the last MSG_HOT_DAYS: Postgres prunes to the newest partitions,
+    # on SQLite the month tables are tried newest first
+    since = now_ts() - MSG_HOT_DAYS * 86400
+    try:
+        if USING_PG:
+            row = await q_one(
+                "SELECT receiver_id FROM messages WHERE sender_id=%s AND msg_type=%s AND ts>=%s "
+                "ORDER BY ts DESC LIMIT 1",
+                (sender_id, msg_type, since)
+            )
+        else:
+            row = None
+            for lo, hi, name in reversed(partitions):
+                if hi <= since:
+                    break
+                row = await q_one(
+                    f"SELECT receiver_id FROM {name} WHERE sender_id=? AND msg_type=? AND ts>=? "
+                    "ORDER BY ts DESC LIMIT 1",
+                    (sender_id, msg_type, since)
+                )
+                if row:
+                    break
+        return int(row[0]) if row else None
+    except Exception:
+        return None
+
+
+async def get_last_owner_for_sender(sender_id: int) -> int | None:
+    return await get_last_receiver(sender_id, "forward")
+
+
+async def get_last_reply_target(owner_id: int) -> int | None:
+    return await get_last_receiver(owner_id, "reply")
+
+
+# ---------- BLOCK LIST ----------
+# The blocks table is the source of truth; block_index is a warm copy loaded
+# at startup and updated write-through by block_user(), so is_blocked() never
+# touches the DB. Each owner's blocked users are a sorted array('q') (8 bytes
+# per entry instead of ~70 for a set of ints) searched with bisect. With several
+# processes set BLOCKS_TTL (seconds) to pull blocks added by the others.
+BLOCKS_TTL = env_float("BLOCKS_TTL", 0.0)
+
+
+class BlockIndex:
+    def __init__(self):
+        self._by_owner = {}  # owner_id -> sorted array('q') of user_ids
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def contains(self, owner_id: int, user_id: int) -> bool:
+        arr = self._by_owner.get(owner_id)
+        if arr is None:
+            return False
+        i = bisect_left(arr, user_id)
+        return i < len(arr) and arr[i] == user_id
+
+    def add(self, owner_id: int, user_id: int) -> bool:
+        arr = self._by_owner.get(owner_id)
+        if arr is None:
+            self._by_owner[owner_id] = array("q", (user_id,))
+            self._count += 1
+            return True
+        i = bisect_left(arr, user_id)
+        if i < len(arr) and arr[i] == user_id:
+            return False
+        arr.insert(i, user_id)
+        self._count += 1
+        return True
+
+    def clear(self):
+        self._by_owner.clear()
+        self._count = 0
+
+    def nbytes(self) -> int:
+        return sum(a.buffer_info()[1] * a.itemsize for a in self._by_owner.values())
+
+
+block_index = BlockIndex()
+blocks_synced_at = 0
+
+
+async def load_blocks():
+    global blocks_synced_at
+    started = now_ts()
+    fresh = BlockIndex()
+    # ordered stream: rows for an owner arrive sorted, so append keeps arrays sorted
+    async with aclosing(q_stream("SELECT owner_id, user_id FROM blocks ORDER BY owner_id, user_id", None, 10000)) as chunks:
+        async for rows in chunks:
+            for owner_id, user_id in rows:
+                arr = fresh._by_owner.get(owner_id)
+                if arr is None:
+                    fresh._by_owner[owner_id] = array("q", (user_id,))
+                else:
+                    arr.append(user_id)
+                fresh._count += 1
+    block_index._by_owner = fresh._by_owner
+    block_index._count = fresh._count
+    blocks_synced_at = started
+
+
+async def blocks_refresher():
+    global blocks_synced_at
+    while True:
+        await asyncio.sleep(BLOCKS_TTL)
+        try:
+            since = blocks_synced_at - 5  # overlap for clock skew / in-flight inserts
+            started = now_ts()
+            if USING_PG:
+                rows = await q_all("SELECT owner_id, user_id FROM blocks WHERE created_at >= %s", (since,))
+            else:
+                rows = await q_all("SELECT owner_id, user_id FROM blocks WHERE created_at >= ?", (since,))
+            for owner_id, user_id in rows:
+                block_index.add(owner_id, user_id)
+            blocks_synced_at = started
+        except Exception as e:
+            print("blocks refresh failed:", repr(e))
+
+
+def is_blocked(owner_id: int, user_id: int) -> bool:
+    return block_index.contains(owner_id, user_id)
+
+
+async def block_user(owner_id: int, user_id: int):
+    if USING_PG:
+        await q(
+            "INSERT INTO blocks (owner_id, user_id, created_at) VALUES (%s,%s,%s) "
+            "ON CONFLICT (owner_id, user_id) DO NOTHING",
+            (owner_id, user_id, now_ts())
+        )
+    else:
+        await q(
+            "INSERT INTO blocks (owner_id, user_id, created_at) VALUES (?,?,?) "
+            "ON CONFLICT (owner_id, user_id) DO NOTHING",
+            (owner_id, user_id, now_ts())
+        )
+    block_index.add(owner_id, user_id)
+
+
+# ---------- STATES ----------
+# Conversation state, per user, in a StateStore. A handler loads everything
+# for its user with one lookup (async with user_state(uid) as st), reads and
+# changes it in memory and the changes are written back when it exits.
+#   STATE_BACKEND=memory (default): process-local dicts, lost on restart
+#   STATE_BACKEND=db: the user_state table, shared by every bot process
+# Keys (all values are ints):
+#   conv               the conversation mode and its argument, packed (see below)
+#   last_owner         owner who last got a forward from this user (last_owner_map)
+#   last_link_owner    owner to go back to on send_again (last_link_owner_for_user)
+#   last_reply_target  who this owner last replied to (last_reply_target_for_owner)
+# A user is in at most one conversation mode at a time; entering a mode
+# replaces the previous one. The next plain message is dispatched on it
+# (message_routes). Modes and their argument:
+#   link               owner_id the next message is forwarded to
+#   reply              target the next message is copied to
+#   direct             waiting for a target id
+#   admin_search, admin_broadcast, admin_set_channel, admin_set_link,
+#   admin_anon_target, admin_text_search, admin_export  admin waiting for input
+#   admin_anon_message target user of the pending anonymous message
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").strip().lower()
+# order is part of the stored encoding: only ever append
+CONV_MODES = (
+    "link", "reply", "direct",
+    "admin_search", "admin_broadcast", "admin_set_channel", "admin_set_link",
+    "admin_anon_target", "admin_anon_message", "admin_text_search", "admin_export",
+)
+CONV_MODE_CODES = {m: i + 1 for i, m in enumerate(CONV_MODES)}
+CONV_SLOTS = 16  # conv = arg * CONV_SLOTS + mode code
+
+
+class UserState:
+    def __init__(self, user_id: int, values: dict):
+        self.user_id = user_id
+        self._values = values
+        self._changed = {}  # key -> new value, None = deleted
+
+    def get(self, key: str, default=None):
+        v = self._values.get(key)
+        return default if v is None else v
+
+    def has(self, key: str) -> bool:
+        return self._values.get(key) is not None
+
+    def set(self, key: str, value: int = 1):
+        self._values[key] = value
+        self._changed[key] = value
+
+    def pop(self, key: str, default=None):
+        v = self._values.pop(key, None)
+        if v is None:
+            return default
+        self._changed[key] = None
+        return v
+
+    def take_changes(self) -> dict:
+        changed, self._changed = self._changed, {}
+        return changed
+
+    @property
+    def mode(self) -> str | None:
+        conv = self._values.get("conv")
+        return None if conv is None else CONV_MODES[conv % CONV_SLOTS - 1]
+
+    @property
+    def mode_arg(self) -> int | None:
+        conv = self._values.get("conv")
+        return None if conv is None else conv // CONV_SLOTS
+
+    def enter(self, mode: str, arg: int = 0):
+        self.set("conv", arg * CONV_SLOTS + CONV_MODE_CODES[mode])
+
+    def leave(self):
+        """Ends the current mode; returns (mode, arg), or (None, None)."""
+        mode, arg = self.mode, self.mode_arg
+        self.pop("conv")
+        return mode, arg
+
+
+class BoundedMap:
+    """int -> int mapping with per-entry TTL and LRU eviction past max_entries."""
+
+    class _Entry:
+        __slots__ = ("value", "expires")
+
+        def __init__(self, value, expires):
+            self.value = value
+            self.expires = expires
+
+    # rough per-entry footprint: OrderedDict node + key int + _Entry + float
+    ENTRY_BYTES = 100 + sys.getsizeof(2 ** 40) + sys.getsizeof(_Entry(0, 0.0)) + sys.getsizeof(0.0)
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: int):
+        e = self._data.get(key)
+        if e is None:
+            self.misses += 1
+            return None
+        if e.expires <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return e.value
+
+    def set(self, key: int, value: int):
+        e = self._data.get(key)
+        expires = time.monotonic() + self.ttl
+        if e is None:
+            self._data[key] = self._Entry(value, expires)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        else:
+            e.value = value
+            e.expires = expires
+            self._data.move_to_end(key)
+
+    def pop(self, key: int):
+        e = self._data.pop(key, None)
+        return e.value if e is not None else None
+
+    def purge_expired(self, budget: int = 1000) -> int:
+        # oldest-touched entries sit at the front; stop at the first live one
+        now = time.monotonic()
+        removed = 0
+        while self._data and removed < budget:
+            key, e = next(iter(self._data.items()))
+            if e.expires > now:
+                break
+            del self._data[key]
+            removed += 1
+        self.expirations += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "max": self.max_entries,
+            "bytes": len(self._data) * self.ENTRY_BYTES,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Memory store limits: the conversation mode expires after STATE_TTL seconds
+# idle, the last_* history after STATE_HISTORY_TTL; either way a miss on
+# last_* falls back to the messages table. STATE_MEMORY_MB caps the whole
+# store, split evenly between the keys; the least recently used users are
+# evicted first.
+STATE_TTL = env_float("STATE_TTL", 86400.0)
+STATE_HISTORY_TTL = env_float("STATE_HISTORY_TTL", 7 * 86400.0)
+STATE_MEMORY_MB = env_float("STATE_MEMORY_MB", 64.0)
+STATE_KEYS = ("conv", "last_owner", "last_link_owner", "last_reply_target")
+STATE_HISTORY_KEYS = ("last_owner", "last_link_owner", "last_reply_target")
+
+
+class MemoryStateStore:
+    def __init__(self):
+        per_key = int(STATE_MEMORY_MB * 1024 * 1024 / len(STATE_KEYS) / BoundedMap.ENTRY_BYTES)
+        self._maps = {}
+        for k in STATE_KEYS:
+            ttl = STATE_HISTORY_TTL if k in STATE_HISTORY_KEYS else STATE_TTL
+            self._maps[k] = BoundedMap(per_key, ttl)
+
+    async def load(self, user_id: int) -> UserState:
+        values = {}
+        for k, m in self._maps.items():
+            v = m.get(user_id)
+            if v is not None:
+                values[k] = v
+        return UserState(user_id, values)
+
+    async def save(self, state: UserState):
+        for k, v in state.take_changes().items():
+            if v is None:
+                self._maps[k].pop(state.user_id)
+            else:
+                self._maps[k].set(state.user_id, v)
+
+    async def get_value(self, user_id: int, key: str):
+        return self._maps[key].get(user_id)
+
+    def purge_expired(self) -> int:
+        return sum(m.purge_expired() for m in self._maps.values())
+
+    def size(self) -> int:
+        return sum(len(m) for m in self._maps.values())
+
+    def stats(self) -> dict:
+        return {k: m.stats() for k, m in self._maps.items()}
+
+
+async def state_purger():
+    while True:
+        await asyncio.sleep(60)
+        state_store.purge_expired()
+
+
+class DBStateStore:
+    async def load(self, user_id: int) -> UserState:
+        if USING_PG:
+            rows = await q_all("SELECT key, value FROM user_state WHERE user_id=%s", (user_id,))
+        else:
+            rows = await q_all("SELECT key, value FROM user_state WHERE user_id=?", (user_id,))
+        return UserState(user_id, {k: v for k, v in rows})
+
+    async def save(self, state: UserState):
+        changed = state.take_changes()
+        if not changed:
+            return
+        ts = now_ts()
+        upserts = [(state.user_id, k, v, ts) for k, v in changed.items() if v is not None]
+        deletes = [k for k, v in changed.items() if v is None]
+        if USING_PG:
+            if deletes:
+                await q("DELETE FROM user_state WHERE user_id=%s AND key = ANY(%s)", (state.user_id, deletes))
+            await q_many(
+                "INSERT INTO user_state (user_id, key, value, updated_at) VALUES (%s,%s,%s,%s) "
+                "ON CONFLICT (user_id, key) DO UPDATE SET value=EXCLUDED.value, updated_at=EXCLUDED.updated_at",
+                upserts
+            )
+        else:
+            if deletes:
+                marks = ",".join("?" * len(deletes))
+                await q(f"DELETE FROM user_state WHERE user_id=? AND key IN ({marks})", (state.user_id, *deletes))
+            await q_many(
+                "INSERT INTO user_state (user_id, key, value, updated_at) VALUES (?,?,?,?) "
+                "ON CONFLICT (user_id, key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
+                upserts
+            )
+
+    async def get_value(self, user_id: int, key: str):
+        if USING_PG:
+            row = await q_one("SELECT value FROM user_state WHERE user_id=%s AND key=%s", (user_id, key))
+        else:
+            row = await q_one("SELECT value FROM user_state WHERE user_id=? AND key=?", (user_id, key))
+        return row[0] if row else None
+
+    def purge_expired(self) -> int:
+        return 0
+
+    def size(self) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        return {}
+
+
+state_store = DBStateStore() if STATE_BACKEND == "db" else MemoryStateStore()
+
+
+@asynccontextmanager
+async def user_state(user_id: int):
+    st = await state_store.load(user_id)
+    try:
+        yield st
+    finally:
+        await state_store.save(st)
+
+
+async def owner_of_sender(sender_id: int) -> int | None:
+    return await state_store.get_value(sender_id, "last_owner") or await get_last_owner_for_sender(sender_id)
+
+
+# ---------- SIGNED CALLBACKS ----------
+# The reply/block buttons under a forwarded message carry who sent it, who it
+# was sent to and until when the button is valid, signed with an HMAC. The
+# permission check is then a constant-time compare: no state, no DB, and it
+# keeps working after restarts and on every instance that shares the secret.
+#   "r:" / "b:" + base64url(sender int64 | owner int64 | expiry uint32 | mac)
+# is 42 bytes, well within Telegram's 64-byte callback_data limit.
+CALLBACK_TTL = env_int("CALLBACK_TTL_DAYS", 90) * 86400
+CALLBACK_MAC_BYTES = 10
+CALLBACK_PAYLOAD = struct.Struct(">qqI")
+
+
+@functools.cache
+def callback_key() -> bytes:
+    secret = os.environ.get("CALLBACK_SECRET", "").strip()
+    if secret:
+        return secret.encode()
+    # same token -> same key on every instance
+    return hashlib.sha256(b"callback-data:" + bot_token().encode()).digest()
+
+
+def _callback_mac(action: str, payload: bytes) -> bytes:
+    return hmac.new(callback_key(), action.encode() + payload, hashlib.sha256).digest()[:CALLBACK_MAC_BYTES]
+
+
+def sign_callback(action: str, sender: int, owner: int) -> str:
+    payload = CALLBACK_PAYLOAD.pack(sender, owner, int(time.time()) + CALLBACK_TTL)
+    raw = payload + _callback_mac(action, payload)
+    return f"{action}:" + base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def verify_callback(data: str) -> tuple[int, int, bool] | None:
+    """(sender, owner, expired) if data carries a valid signature, else None."""
+    action, _, body = data.partition(":")
+    try:
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+    except ValueError:
+        return None
+    if len(raw) != CALLBACK_PAYLOAD.size + CALLBACK_MAC_BYTES:
+        return None
+    payload, mac = raw[:CALLBACK_PAYLOAD.size], raw[CALLBACK_PAYLOAD.size:]
+    if not hmac.compare_digest(mac, _callback_mac(action, payload)):
+        return None
+    sender, owner, expires = CALLBACK_PAYLOAD.unpack(payload)
+    return sender, owner, expires < time.time()
+
+
+def sender_buttons(sender: int, owner: int):
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✉️ پاسخ", callback_data=sign_callback("r", sender, owner)),
+            InlineKeyboardButton("🚫 بلاک", callback_data=sign_callback("b", sender, owner))
+        ]
+    ])
+
+
+# ---------- MENUS ----------
+def main_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📎 دریافت لینک اختصاصی", callback_data="get_link")],
+        [InlineKeyboardButton("✉️ ارسال پیام مستقیم", callback_data="send_direct")]
+    ])
+
+def admin_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("👥 آمار کاربران", callback_data="admin_stats")],
+        [InlineKeyboardButton("🆕 ۱۵ کاربر آخر", callback_data="admin_latest_users")],
+        [InlineKeyboardButton("🔍 مشاهده پیام‌های کاربر (با محتوا)", callback_data="admin_search")],
+        [InlineKeyboardButton("🔎 جستجو در متن پیام‌ها", callback_data="admin_text_search")],
+        [InlineKeyboardButton("✉️ پیام ناشناس به کاربر", callback_data="admin_anon_send")],
         [InlineKeyboardButton("📢 ارسال پیام به همه", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("📦 خروجی کاربران/پیام‌ها", callback_data="admin_export")],
         [InlineKeyboardButton("⚙️ تنظیمات جوین اجباری", callback_data="admin_settings")],
     ])
 
-def admin_settings_menu():
-    enabled = get_bool_setting("force_join_enabled", False)
-    status_text = "روشن ✅" if enabled else "خاموش ❌"
-    ch = get_setting("force_join_channel", "@YOUR_CHANNEL")
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"🔒 جوین اجباری: {status_text}", callback_data="toggle_force_join")],
-        [InlineKeyboardButton(f"📢 تنظیم کانال (فعلی: {ch})", callback_data="set_force_join_channel")],
-        [InlineKeyboardButton("🔗 تنظیم لینک کانال", callback_data="set_force_join_link")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="back_admin")],
-    ])
+def admin_settings_menu():
+    enabled = get_bool_setting("force_join_enabled", False)
+    status_text = "روشن ✅" if enabled else "خاموش ❌"
+    ch = get_setting("force_join_channel", "@YOUR_CHANNEL")
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"🔒 جوین اجباری: {status_text}", callback_data="toggle_force_join")],
+        [InlineKeyboardButton(f"📢 تنظیم کانال (فعلی: {ch})", callback_data="set_force_join_channel")],
+        [InlineKeyboardButton("🔗 تنظیم لینک کانال", callback_data="set_force_join_link")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="back_admin")],
+    ])
+
+def after_send_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✉️ ارسال دوباره پیام", callback_data="send_again")],
+        [InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data="back_menu")]
+    ])
+
+
+# ---------- START ----------
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    save_user(user)
+
+    # start with link: /start <owner_id>
+    mark_branch("link" if context.args else "menu")
+    if context.args:
+        if not await must_join(update, context):
+            return
+
+        owner_id = int(context.args[0])
+        if is_blocked(owner_id, user.id):
+            return
+
+        async with user_state(user.id) as st:
+            st.enter("link", owner_id)
+            st.set("last_link_owner", owner_id)
+        await update.message.reply_text("پیامت رو بفرست ✉️")
+        return
+
+    if user.id in ADMIN_IDS:
+        await update.message.reply_text("🛠 پنل مدیریت", reply_markup=admin_menu())
+        return
+
+    if not await must_join(update, context):
+        return
+
+    await update.message.reply_text("سلام 👋", reply_markup=main_menu())
+
+
+# ---------- BUTTONS ----------
+# Callbacks are routed through a table instead of an if/elif chain: exact
+# callback_data in callback_routes, parametric ones ("srch:...", "r:<signed>")
+# in callback_prefixes keyed by everything up to the first ":" or "_". Either
+# way it's one dict lookup. The user's state is loaded once per callback.
+STATS_DAYS = 7
+STATS_MESSAGE_TYPES = (("forward", "از طریق لینک"), ("reply", "پاسخ"), ("admin_anonymous", "ناشناس ادمین"))
+
+callback_routes = {}    # callback_data -> (handler, name, admin_only, join)
+callback_prefixes = {}  # "srch:", "r:", "reply_", ... -> (handler, name, admin_only, join)
+CALLBACK_PREFIX_RE = re.compile(r"[^:_]*[:_]")
+
+
+def on_callback(data: str, admin_only: bool = False, join: bool = False):
+    """Register a button handler; data ending in ":" or "_" is a prefix route.
+    join: normal users must pass the force-join check first."""
+    def deco(fn):
+        if data[-1] in ":_":
+            callback_prefixes[data] = (fn, data[:-1], admin_only, join)
+        else:
+            callback_routes[data] = (fn, data, admin_only, join)
+        return fn
+    return deco
+
+
+def find_callback_route(data: str):
+    route = callback_routes.get(data)
+    if route is None:
+        m = CALLBACK_PREFIX_RE.match(data)
+        route = callback_prefixes.get(m.group()) if m else None
+    return route
+
+
+async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    qy = update.callback_query
+    route = find_callback_route(qy.data or "")
+    mark_branch(route[1] if route else "other")
+    await qy.answer()
+    if route is None:
+        return
+    handler, _name, admin_only, join = route
+    uid = qy.from_user.id
+
+    if uid not in ADMIN_IDS:
+        if admin_only:
+            return
+        if join and not await must_join(update, context):
+            return
+
+    async with user_state(uid) as st:
+        await handler(update, context, st)
+
+
+@on_callback("get_link", join=True)
+async def cb_get_link(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    qy = update.callback_query
+    link = f"https://t.me/{context.bot.username}?start={qy.from_user.id}"
+    await qy.message.reply_text(link)
+
+
+@on_callback("send_direct", join=True)
+async def cb_send_direct(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("direct")
+    await update.callback_query.message.reply_text("آیدی عددی مخاطب رو بفرست:")
+
+
+@on_callback("send_again", join=True)
+async def cb_send_again(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    qy = update.callback_query
+    uid = qy.from_user.id
+    # ✅ FIX: actually set state again
+    # If user previously used a link, re-enable link forwarding
+    if uid not in ADMIN_IDS:
+        owner = st.get("last_link_owner") or await get_last_owner_for_sender(uid)
+        if owner:
+            st.enter("link", owner)
+            st.set("last_link_owner", owner)
+            await qy.message.reply_text("پیامت رو بفرست ✉️")
+        else:
+            await qy.message.reply_text("لینک اختصاصی قبلی پیدا نشد. دوباره از لینک وارد شو.")
+        return
+
+    # For admin/owner: if they recently replied, set reply state again
+    target = st.get("last_reply_target") or await get_last_reply_target(uid)
+    if target:
+        st.enter("reply", target)
+        await qy.message.reply_text("پاسخت رو بفرست ✉️")
+    else:
+        await qy.message.reply_text("مخاطب قبلی برای پاسخ پیدا نشد.")
+
+
+@on_callback("back_menu", join=True)
+async def cb_back_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.leave()
+    await update.callback_query.message.reply_text("منوی اصلی 👇", reply_markup=main_menu())
+
+
+# -------- ADMIN --------
+@on_callback("admin_stats", admin_only=True)
+async def cb_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await user_directory.flush()
+    await message_log.flush()
+    totals, daily = await stats_summary(STATS_DAYS)
+    today = daily.get(stats_day(now_ts()), {})
+    text = (
+        f"👥 تعداد کاربران: {totals.get('users', 0)}\n"
+        f"🆕 کاربران جدید امروز: {today.get('new_users', 0)}\n"
+        f"🔥 کاربران فعال امروز: {today.get('active_users', 0)}\n"
+        f"✉️ کل پیام‌ها: {totals.get('messages', 0)} (امروز: {today.get('messages', 0)})\n"
+    )
+    for msg_type, label in STATS_MESSAGE_TYPES:
+        text += f"  • {label}: {totals.get('messages:' + msg_type, 0)}\n"
+    text += f"\n📅 {STATS_DAYS} روز اخیر (جدید / فعال / پیام):\n"
+    for day in sorted(daily, reverse=True):
+        d = daily[day]
+        text += f"{day}: {d.get('new_users', 0)} / {d.get('active_users', 0)} / {d.get('messages', 0)}\n"
+    mc = membership_cache.stats()
+    text += (
+        f"\n🗂 کش عضویت کانال: {mc['size']} مورد\n"
+        f"hit: {mc['hits']} | miss: {mc['misses']} | evict: {mc['evictions']} "
+        f"({mc['hit_ratio']:.0%})"
+    )
+    ss = state_store.stats()
+    if ss:
+        total_bytes = sum(m["bytes"] for m in ss.values())
+        text += f"\n\n🧠 وضعیت‌ها در حافظه: {state_store.size()} مورد (~{total_bytes // 1024} KB)"
+        for k in STATE_HISTORY_KEYS:
+            m = ss[k]
+            text += f"\n{k}: {m['size']}/{m['max']} | evict: {m['evictions']} | expire: {m['expirations']}"
+    await update.callback_query.message.reply_text(text)
+
+
+@on_callback("admin_latest_users", admin_only=True)
+async def cb_admin_latest_users(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    qy = update.callback_query
+    await user_directory.flush()
+    if USING_PG:
+        rows = await q_all("SELECT user_id, full_name, username FROM users ORDER BY last_seen DESC NULLS LAST LIMIT 15")
+    else:
+        rows = await q_all("SELECT user_id, full_name, username FROM users ORDER BY last_seen DESC LIMIT 15")
+    if not rows:
+        await qy.message.reply_text("هنوز کاربری ثبت نشده.")
+        return
+    lines = []
+    for user_id, full_name, username in rows:
+        name = full_name if full_name else "-"
+        uname = f"@{username}" if username else "-"
+        lines.append(f"👤 {name}\nID: {user_id}\nUsername: {uname}\n")
+    await qy.message.reply_text("🆕 ۱۵ کاربر آخر:\n\n" + "\n".join(lines))
+
+
+@on_callback("admin_search", admin_only=True)
+async def cb_admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_search")
+    await update.callback_query.message.reply_text("آیدی عددی کاربر رو بفرست:")
+
+
+@on_callback("admin_text_search", admin_only=True)
+async def cb_admin_text_search(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_text_search")
+    await update.callback_query.message.reply_text("کلمه یا عبارت مورد نظر رو بفرست:")
+
+
+@on_callback("admin_export", admin_only=True)
+async def cb_admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_export")
+    await update.callback_query.message.reply_text(EXPORT_HELP)
+
+
+@on_callback("admin_anon_send", admin_only=True)
+async def cb_admin_anon_send(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_anon_target")
+    await update.callback_query.message.reply_text("آیدی عددی کاربر رو بفرست:")
+
+
+@on_callback("admin_broadcast", admin_only=True)
+async def cb_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_broadcast")
+    await update.callback_query.message.reply_text("پیام همگانی رو بفرست:")
+
+
+@on_callback("admin_settings", admin_only=True)
+async def cb_admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await update.callback_query.message.reply_text("⚙️ تنظیمات جوین اجباری", reply_markup=admin_settings_menu())
+
+
+@on_callback("toggle_force_join", admin_only=True)
+async def cb_toggle_force_join(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await set_bool_setting("force_join_enabled", not get_bool_setting("force_join_enabled", False))
+    await update.callback_query.message.reply_text("✅ ذخیره شد.", reply_markup=admin_settings_menu())
+
+
+@on_callback("set_force_join_channel", admin_only=True)
+async def cb_set_force_join_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_set_channel")
+    await update.callback_query.message.reply_text("یوزرنیم کانال رو بفرست (مثل @mychannel) یا -100...:")
+
+
+@on_callback("set_force_join_link", admin_only=True)
+async def cb_set_force_join_link(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.enter("admin_set_link")
+    await update.callback_query.message.reply_text("لینک کانال رو بفرست (مثل https://t.me/mychannel):")
+
+
+@on_callback("back_admin", admin_only=True)
+async def cb_back_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await update.callback_query.message.reply_text("🛠 پنل مدیریت", reply_markup=admin_menu())
+
+
+@on_callback("srch:", admin_only=True)
+async def cb_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    qy = update.callback_query
+    _, direction, target, cur_ts, cur_id = qy.data.split(":")
+    text, markup = await search_page(int(target), direction, int(cur_ts), int(cur_id))
+    if text is None:
+        await qy.message.reply_text("پیام دیگری نیست.")
+        return
+    await qy.message.edit_text(text, reply_markup=markup)
+
+
+async def signed_target(update: Update) -> int | None:
+    """Sender named by a signed reply/block button, if the clicker may act on it."""
+    qy = update.callback_query
+    uid = qy.from_user.id
+    checked = verify_callback(qy.data)
+    if checked is None:
+        await qy.message.reply_text("⛔️ اجازه نداری.")
+        return None
+    sender, owner, expired = checked
+    if uid not in ADMIN_IDS and uid != owner:
+        await qy.message.reply_text("⛔️ اجازه نداری.")
+        return None
+    if expired:
+        await qy.message.reply_text("⌛️ این دکمه منقضی شده.")
+        return None
+    return sender
+
+
+# Buttons sent before signed callbacks existed ("reply_<id>", "block_<id>")
+# still need the owner lookup.
+async def legacy_target(update: Update) -> int | None:
+    qy = update.callback_query
+    uid = qy.from_user.id
+    target_sender = int(qy.data.split("_")[1])
+
+    # ✅ FIX: allow admin OR owner who received the message
+    if uid not in ADMIN_IDS and uid != await owner_of_sender(target_sender):
+        await qy.message.reply_text("⛔️ اجازه نداری.")
+        return None
+    return target_sender
+
+
+async def start_reply(update: Update, st: UserState, target_sender: int | None):
+    if target_sender is None:
+        return
+    st.enter("reply", target_sender)
+    st.set("last_reply_target", target_sender)
+    await update.callback_query.message.reply_text("پاسخت رو بفرست:")
+
+
+async def block_sender(update: Update, target_sender: int | None):
+    if target_sender is None:
+        return
+    await block_user(update.callback_query.from_user.id, target_sender)
+    await update.callback_query.message.reply_text("🚫 کاربر بلاک شد")
+
+
+@on_callback("r:")
+async def cb_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await start_reply(update, st, await signed_target(update))
+
+
+@on_callback("b:")
+async def cb_block(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await block_sender(update, await signed_target(update))
+
+
+@on_callback("fts:", admin_only=True)
+async def cb_fts_page(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    qy = update.callback_query
+    _, qid, offset = qy.data.split(":")
+    if int(qid) not in fts_queries:
+        await qy.message.reply_text("این جستجو منقضی شده، دوباره جستجو کن.")
+        return
+    text, markup = await fts_page(int(qid), int(offset))
+    if text is None:
+        await qy.message.reply_text("نتیجه دیگری نیست.")
+        return
+    await qy.message.edit_text(text, reply_markup=markup)
+
+
+@on_callback("reply_")
+async def cb_reply_legacy(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await start_reply(update, st, await legacy_target(update))
+
+
+@on_callback("block_")
+async def cb_block_legacy(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    await block_sender(update, await legacy_target(update))
+
+
+# ---------- ADMIN SEARCH ----------
+# Messages of one user, newest first, one Telegram message per page. Pages
+# are keyset-paginated on (ts, id): each page is a single query, a UNION ALL
+# of the (sender_id, ts, id) and (receiver_id, ts, id) index scans, so any
+# depth costs the same. Buttons carry the page edge as "srch:<dir>:<user>:<ts>:<id>".
+# Past the oldest row still in the DB, pages continue from the archive files.
+SEARCH_PAGE_ROWS = env_int("SEARCH_PAGE_ROWS", 20)
+SEARCH_TEXT_LIMIT = 4000      # Telegram caps a message at 4096 chars
+SEARCH_CONTENT_LIMIT = 400    # per-row preview
+SEARCH_CURSOR_MAX = 2 ** 63 - 1
+
+
+async def fetch_search_rows(target: int, direction: str, cur_ts: int, cur_id: int, limit: int):
+    # direction "o": older than the cursor, newest first; "n": newer, oldest first
+    if direction == "o":
+        cmp, order = "<", "DESC"
+    else:
+        cmp, order = ">", "ASC"
+    if USING_PG:
+        sql = (
+            "SELECT * FROM ("
+            " SELECT id, sender_id, receiver_id, msg_type, content, ts FROM messages"
+            f" WHERE sender_id=%s AND (ts, id) {cmp} (%s, %s) ORDER BY ts {order}, id {order} LIMIT %s) AS s "
+            "UNION ALL "
+            "SELECT * FROM ("
+            " SELECT id, sender_id, receiver_id, msg_type, content, ts FROM messages"
+            f" WHERE receiver_id=%s AND sender_id<>%s AND (ts, id) {cmp} (%s, %s) ORDER BY ts {order}, id {order} LIMIT %s) AS r "
+            f"ORDER BY ts {order}, id {order} LIMIT %s"
+        )
+    else:
+        sql = (
+            "SELECT * FROM ("
+            " SELECT id, sender_id, receiver_id, msg_type, content, ts FROM messages"
+            f" WHERE sender_id=? AND (ts, id) {cmp} (?, ?) ORDER BY ts {order}, id {order} LIMIT ?) AS s "
+            "UNION ALL "
+            "SELECT * FROM ("
+            " SELECT id, sender_id, receiver_id, msg_type, content, ts FROM messages"
+            f" WHERE receiver_id=? AND sender_id<>? AND (ts, id) {cmp} (?, ?) ORDER BY ts {order}, id {order} LIMIT ?) AS r "
+            f"ORDER BY ts {order}, id {order} LIMIT ?"
+        )
+    rows = await q_all(sql, (target, cur_ts, cur_id, limit, target, target, cur_ts, cur_id, limit, limit))
+    if archives and len(rows) < limit and (direction == "o" or cur_ts < archives[-1][1]):
+        rows = list(rows) + await fetch_archived_search_rows(target, direction, cur_ts, cur_id, limit)
+        rows.sort(key=lambda r: (r[5], r[0]), reverse=direction == "o")
+        rows = rows[:limit]
+    return rows
+
+
+def format_search_row(row) -> str:
+    _id, sender_id, receiver_id, msg_type, content, ts = row
+    content = content or "(بدون متن/فایل)"
+    if len(content) > SEARCH_CONTENT_LIMIT:
+        content = content[:SEARCH_CONTENT_LIMIT] + "…"
+    return f"📩 {ts}\nاز {sender_id} به {receiver_id}\nنوع: {msg_type}\nمحتوا: {content}"
+
+
+async def search_page(target: int, direction: str, cur_ts: int, cur_id: int):
+    """Returns (text, markup) for one page, or (None, None) when there is nothing there."""
+    rows = await fetch_search_rows(target, direction, cur_ts, cur_id, SEARCH_PAGE_ROWS + 1)
+    if not rows:
+        return None, None
+
+    # rows come nearest-to-cursor first; pack as many as fit in one message
+    header = f"🔍 پیام‌های کاربر {target}\n\n"
+    size = len(header)
+    shown = []
+    for row in rows[:SEARCH_PAGE_ROWS]:
+        block = format_search_row(row)
+        if shown and size + len(block) + 2 > SEARCH_TEXT_LIMIT:
+            break
+        shown.append((row, block))
+        size += len(block) + 2
+    more = len(shown) < len(rows)
+
+    if direction == "o":
+        has_older, has_newer = more, cur_ts != SEARCH_CURSOR_MAX
+    else:
+        has_older, has_newer = True, more
+        shown.reverse()
+
+    first, last = shown[0][0], shown[-1][0]
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("⬅️ جدیدتر", callback_data=f"srch:n:{target}:{first[5]}:{first[0]}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("قدیمی‌تر ➡️", callback_data=f"srch:o:{target}:{last[5]}:{last[0]}"))
+    text = header + "\n\n".join(block for _, block in shown)
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+# ---------- FULL-TEXT SEARCH ----------
+# Keyword search over message content, best matches first. Postgres matches
+# the indexed content_tsv column against a prefix tsquery and ranks with
+# ts_rank; SQLite matches messages_fts and ranks by bm25, then loads the page's
+# rows by id. Both sides see text through fts_normalize() (TEXT NORMALIZATION).
+# Every term must match, as a word prefix ("کتاب" finds "کتابها").
+# Archived months aren't searched. Pages go by offset; the query text stays
+# in memory under a short id, carried by the buttons as "fts:<id>:<offset>".
+FTS_PAGE_ROWS = env_int("FTS_PAGE_ROWS", 10)
+FTS_MAX_TERMS = 8
+FTS_QUERIES_MAX = 256
+FTS_TERM_RE = re.compile(r"[^\W_]+")
+
+fts_queries = OrderedDict()  # id -> query text, most recent last
+fts_query_ids = itertools.count(int(time.time()))  # ids from before a restart stay unused
+
+
+def fts_terms(text: str) -> list[str]:
+    return FTS_TERM_RE.findall(fts_normalize(text))[:FTS_MAX_TERMS]
+
+
+def remember_fts_query(text: str) -> int:
+    qid = next(fts_query_ids)
+    fts_queries[qid] = text
+    while len(fts_queries) > FTS_QUERIES_MAX:
+        fts_queries.popitem(last=False)
+    return qid
+
+
+async def fetch_fts_rows(terms: list[str], offset: int, limit: int):
+    if USING_PG:
+        return await q_all(
+            "SELECT id, sender_id, receiver_id, msg_type, content, ts "
+            "FROM messages, to_tsquery('simple', %s) AS query WHERE content_tsv @@ query "
+            "ORDER BY ts_rank(content_tsv, query) DESC, ts DESC, id DESC LIMIT %s OFFSET %s",
+            (" & ".join(f"{t}:*" for t in terms), limit, offset)
+        )
+    ids = [r[0] for r in await q_all(
+        "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rank, rowid DESC LIMIT ? OFFSET ?",
+        (" ".join(f'"{t}"*' for t in terms), limit, offset)
+    )]
+    if not ids:
+        return []
+    marks = ",".join("?" * len(ids))
+    rows = {r[0]: r for r in await q_all(
+        f"SELECT id, sender_id, receiver_id, msg_type, content, ts FROM messages WHERE id IN ({marks})", ids
+    )}
+    return [rows[i] for i in ids if i in rows]
+
+
+async def fts_page(qid: int, offset: int):
+    """Returns (text, markup) for one page of results, or (None, None) when there are none."""
+    query = fts_queries.get(qid)
+    terms = fts_terms(query or "")
+    if not terms:
+        return None, None
+    rows = await fetch_fts_rows(terms, offset, FTS_PAGE_ROWS + 1)
+    if not rows:
+        return None, None
+
+    header = f"🔎 نتایج جستجو برای «{query[:100]}» (از {offset + 1})\n\n"
+    size = len(header)
+    shown = []
+    for row in rows[:FTS_PAGE_ROWS]:
+        block = format_search_row(row)
+        if shown and size + len(block) + 2 > SEARCH_TEXT_LIMIT:
+            break
+        shown.append(block)
+        size += len(block) + 2
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(
+            "⬅️ قبلی", callback_data=f"fts:{qid}:{max(0, offset - FTS_PAGE_ROWS)}"))
+    if len(shown) < len(rows):
+        buttons.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"fts:{qid}:{offset + len(shown)}"))
+    return header + "\n\n".join(shown), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+# ---------- OUTBOUND ----------
+# Every Bot API call goes through `outbox`, installed as the application's
+# rate limiter, so all send sites share one set of limits. Calls that send
+# or edit messages take a turn in their chat's lane and then a token from a
+# global bucket (OUTBOX_RATE msg/s, Telegram allows about 30).
+# Lanes pace one chat. Private chats get OUTBOX_CHAT_RATE msg/s with bursts of
+# OUTBOX_CHAT_BURST; Telegram tolerates short bursts there. Groups and
+# channels get OUTBOX_GROUP_RATE (about 20/min is allowed). While a chat has
+# sends queued, its lane grants turns FIFO from its own drain task.
+# Waiting for a turn, for the global bucket or after a RetryAfter happens
+# under worker_idle(), so the handler gives its worker slot to other updates
+# meanwhile. A busy chat only holds up the sends to that chat.
+# There are two priority classes. Interactive is the default, for answers to
+# whoever is talking to the bot. Bulk is for broadcasts, passed as
+# rate_limit_args=OUTBOX_BULK, and only gets a global token while no
+# interactive send is waiting for one. A RetryAfter pauses the chat's lane,
+# and for bulk sends all bulk traffic too. The call is then retried, up to
+# OUTBOX_MAX_RETRIES times.
+OUTBOX_RATE = env_float("OUTBOX_RATE", 30.0)
+OUTBOX_CHAT_RATE = env_float("OUTBOX_CHAT_RATE", 1.0)
+OUTBOX_CHAT_BURST = env_float("OUTBOX_CHAT_BURST", 20.0)
+OUTBOX_GROUP_RATE = env_float("OUTBOX_GROUP_RATE", 20 / 60)
+OUTBOX_GROUP_BURST = env_float("OUTBOX_GROUP_BURST", 3.0)
+OUTBOX_CHAT_BUCKETS = 10000  # idle chats' lanes are dropped LRU-first
+OUTBOX_MAX_RETRIES = 2
+OUTBOX_INTERACTIVE = "interactive"
+OUTBOX_BULK = "bulk"
+OUTBOX_LIMITED = ("send", "forward", "copy", "edit")  # endpoint prefixes that count as messages
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class ChatLane:
+    """One chat's sends: a bucket plus the FIFO of sends waiting for a turn."""
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = deque()  # futures, resolved in order by the drain task
+        self.task = None
+
+
+class Outbox(BaseRateLimiter):
+    def __init__(self, rate: float):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chats = OrderedDict()  # chat_id -> ChatLane
+        self.bulk_paused_until = 0.0
+        self.waiting = {OUTBOX_INTERACTIVE: 0, OUTBOX_BULK: 0}  # sends waiting for a global token
+        self.retries = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for lane in self.chats.values():
+            if lane.task is not None:
+                lane.task.cancel()
+
+    def lane(self, chat_id) -> ChatLane:
+        lane = self.chats.get(chat_id)
+        if lane is not None:
+            self.chats.move_to_end(chat_id)
+            return lane
+        if str(chat_id).startswith(("-", "@")):  # groups, channels
+            lane = ChatLane(OUTBOX_GROUP_RATE, OUTBOX_GROUP_BURST)
+        else:
+            lane = ChatLane(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        self.chats[chat_id] = lane
+        if len(self.chats) > OUTBOX_CHAT_BUCKETS:
+            oldest = next(iter(self.chats))
+            if not self.chats[oldest].queue:
+                del self.chats[oldest]
+        return lane
+
+    async def _drain(self, lane: ChatLane):
+        try:
+            while lane.queue:
+                await lane.bucket.acquire()
+                while lane.queue:
+                    fut = lane.queue.popleft()
+                    if not fut.done():  # skip sends cancelled while queued
+                        fut.set_result(None)
+                        break
+        finally:
+            lane.task = None
+
+    async def _chat_turn(self, chat_id):
+        lane = self.lane(chat_id)
+        if not lane.queue and lane.bucket.try_acquire():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        lane.queue.append(fut)
+        if lane.task is None:
+            lane.task = asyncio.get_running_loop().create_task(self._drain(lane))
+        async with worker_idle():
+            await fut
+
+    async def _global_turn(self, priority: str):
+        if priority == OUTBOX_INTERACTIVE and self.global_bucket.try_acquire():
+            return
+        self.waiting[priority] += 1
+        try:
+            async with worker_idle():
+                while True:
+                    if priority == OUTBOX_BULK:
+                        now = time.monotonic()
+                        if now < self.bulk_paused_until:
+                            await asyncio.sleep(self.bulk_paused_until - now)
+                            continue
+                        if self.waiting[OUTBOX_INTERACTIVE]:
+                            await asyncio.sleep(1 / self.global_bucket.rate)
+                            continue
+                    if self.global_bucket.try_acquire():
+                        return
+                    await asyncio.sleep(max(0.001, (1 - self.global_bucket.tokens) / self.global_bucket.rate))
+        finally:
+            self.waiting[priority] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(OUTBOX_LIMITED):
+            return await callback(*args, **kwargs)
+        priority = OUTBOX_BULK if rate_limit_args == OUTBOX_BULK else OUTBOX_INTERACTIVE
+        chat_id = data.get("chat_id")
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            if chat_id is not None:
+                await self._chat_turn(chat_id)
+            await self._global_turn(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == OUTBOX_MAX_RETRIES:
+                    raise
+                self.retries += 1
+                metrics.inc("bot_outbox_retry_after_total", (("class", priority),))
+                wait = float(e.retry_after)
+                if chat_id is not None:
+                    self.lane(chat_id).bucket.pause(wait)
+                if priority == OUTBOX_BULK:
+                    self.bulk_paused_until = max(self.bulk_paused_until, time.monotonic() + wait)
+                else:
+                    async with worker_idle():
+                        await asyncio.sleep(wait)
+
+
+outbox = Outbox(OUTBOX_RATE)
+metrics.describe("bot_outbox_retry_after_total", "counter", "RetryAfter answers retried by the outbox, by class")
+
+
+# ---------- BROADCAST ----------
+# Broadcasts run as background jobs persisted in the broadcasts table.
+# Recipients are read in user_id order, BROADCAST_BATCH at a time with a
+# keyset query (user_id > last_user_id ... LIMIT), so no transaction stays
+# open while a batch is sent. They are sent by BROADCAST_CONCURRENCY workers
+# sharing a token bucket of BROADCAST_RATE msg/s, as bulk sends through the
+# outbox (which keeps them behind interactive traffic and handles RetryAfter).
+# After every batch last_user_id is saved, so a crash or restart resumes from
+# there (at most one batch can be re-sent). A DB or network error doesn't end
+# the job: it carries on from last_user_id after a backoff of up to
+# BROADCAST_RETRY_MAX seconds. The admin's status message is edited with
+# progress, and a summary is always sent at the end, also when the job fails.
+BROADCAST_RATE = env_float("BROADCAST_RATE", 25.0)
+BROADCAST_CONCURRENCY = env_int("BROADCAST_CONCURRENCY", 20)
+BROADCAST_BATCH = env_int("BROADCAST_BATCH", 500)
+BROADCAST_PROGRESS_INTERVAL = env_float("BROADCAST_PROGRESS_INTERVAL", 10.0)
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_RETRY_MAX = env_float("BROADCAST_RETRY_MAX", 300.0)
+BROADCAST_TRANSIENT = (NetworkError, OSError, sqlite3.OperationalError)
+if USING_PG:
+    import psycopg
+    BROADCAST_TRANSIENT += (psycopg.OperationalError,)
+
+
+class BroadcastJob:
+    def __init__(self, row):
+        (self.id, self.admin_id, self.from_chat_id, self.message_id, self.last_user_id,
+         self.delivered, self.failed, self.total, self.status_message_id) = row
+        self.last_user_id = self.last_user_id or 0
+        self.delivered = self.delivered or 0
+        self.failed = self.failed or 0
+        self.total = self.total or 0
+        self.started = time.monotonic()
+        self.sent_this_run = 0
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.sent_this_run / elapsed if elapsed > 0 else 0.0
+
+    def progress_text(self, final: bool = False, failed: bool = False) -> str:
+        done = self.delivered + self.failed
+        pct = f" ({done * 100 // self.total}%)" if self.total else ""
+        if failed:
+            head = "⚠️ پیام همگانی به خطا خورد و متوقف شد"
+        else:
+            head = "✅ پیام همگانی تمام شد" if final else "📢 در حال ارسال پیام همگانی..."
+        return (
+            f"{head}\n"
+            f"پیشرفت: {done}/{self.total}{pct}\n"
+            f"✅ موفق: {self.delivered}\n"
+            f"❌ ناموفق: {self.failed}\n"
+            f"⚡️ سرعت: {self.rate():.1f} پیام/ثانیه"
+        )
+
+
+BROADCAST_COLUMNS = "id, admin_id, from_chat_id, message_id, last_user_id, delivered, failed, total, status_message_id"
+running_broadcasts = {}  # broadcast id -> BroadcastJob
+
+
+async def save_broadcast_progress(job: BroadcastJob, status: str = "running"):
+    if USING_PG:
+        await q(
+            "UPDATE broadcasts SET status=%s, last_user_id=%s, delivered=%s, failed=%s, updated_at=%s WHERE id=%s",
+            (status, job.last_user_id, job.delivered, job.failed, now_ts(), job.id)
+        )
+    else:
+        await q(
+            "UPDATE broadcasts SET status=?, last_user_id=?, delivered=?, failed=?, updated_at=? WHERE id=?",
+            (status, job.last_user_id, job.delivered, job.failed, now_ts(), job.id)
+        )
+
+
+async def create_broadcast(admin_id: int, from_chat_id: int, message_id: int) -> BroadcastJob:
+    await user_directory.flush()
+    row = await q_one("SELECT COUNT(*) FROM users WHERE is_admin=0")
+    total = row[0] if row else 0
+    ts = now_ts()
+    if USING_PG:
+        row = await q_one(
+            "INSERT INTO broadcasts (admin_id, from_chat_id, message_id, status, last_user_id, delivered, failed, "
+            "total, created_at, updated_at) VALUES (%s,%s,%s,'running',0,0,0,%s,%s,%s) RETURNING id",
+            (admin_id, from_chat_id, message_id, total, ts, ts)
+        )
+    else:
+        row = await q_one(
+            "INSERT INTO broadcasts (admin_id, from_chat_id, message_id, status, last_user_id, delivered, failed, "
+            "total, created_at, updated_at) VALUES (?,?,?,'running',0,0,0,?,?,?) RETURNING id",
+            (admin_id, from_chat_id, message_id, total, ts, ts)
+        )
+    return BroadcastJob((row[0], admin_id, from_chat_id, message_id, 0, 0, 0, total, None))
+
+
+async def set_broadcast_status_message(job: BroadcastJob, status_message_id: int):
+    job.status_message_id = status_message_id
+    if USING_PG:
+        await q("UPDATE broadcasts SET status_message_id=%s WHERE id=%s", (status_message_id, job.id))
+    else:
+        await q("UPDATE broadcasts SET status_message_id=? WHERE id=?", (status_message_id, job.id))
+
+
+async def broadcast_send_one(bot, job: BroadcastJob, bucket: TokenBucket, chat_id: int):
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await bot.copy_message(
+                chat_id=chat_id, from_chat_id=job.from_chat_id, message_id=job.message_id,
+                rate_limit_args=OUTBOX_BULK,
+            )
+            job.delivered += 1
+            job.sent_this_run += 1
+            return
+        except RetryAfter as e:
+            # still flooded after the outbox's own retries: back off every worker
+            bucket.pause(float(e.retry_after))
+        except (Forbidden, BadRequest):
+            # bot blocked / chat gone: retrying won't help
+            break
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(1 + attempt)
+    job.failed += 1
+    job.sent_this_run += 1
+
+
+async def update_broadcast_status(bot, job: BroadcastJob, final: bool = False, failed: bool = False):
+    try:
+        if job.status_message_id and not final:
+            await bot.edit_message_text(
+                chat_id=job.admin_id, message_id=job.status_message_id, text=job.progress_text()
+            )
+        elif final:
+            await bot.send_message(chat_id=job.admin_id, text=job.progress_text(final=True, failed=failed))
+    except Exception:
+        # "message is not modified" and friends: progress display is best effort
+        pass
+
+
+async def run_broadcast(bot, job: BroadcastJob):
+    bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+    last_status = time.monotonic()
+    committed = (job.delivered, job.failed)  # counters as of the last saved batch
+    sql = (
+        "SELECT user_id FROM users WHERE is_admin=0 AND user_id>%s ORDER BY user_id LIMIT %s" if USING_PG else
+        "SELECT user_id FROM users WHERE is_admin=0 AND user_id>? ORDER BY user_id LIMIT ?"
+    )
+    errors = 0  # transient errors in a row
+    try:
+        while True:
+            try:
+                rows = await q_all(sql, (job.last_user_id, BROADCAST_BATCH))
+                if not rows:
+                    await save_broadcast_progress(job, "done")
+                    break
+                pending = iter([r[0] for r in rows])
 
-def after_send_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✉️ ارسال دوباره پیام", callback_data="send_again")],
-        [InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data="back_menu")]
-    ])
+                async def worker():
+                    for chat_id in pending:
+                        await broadcast_send_one(bot, job, bucket, chat_id)
 
+                await asyncio.gather(*(worker() for _ in range(max(1, BROADCAST_CONCURRENCY))))
+                job.last_user_id = rows[-1][0]
+                await save_broadcast_progress(job)
+                committed = (job.delivered, job.failed)
+                errors = 0
+            except BROADCAST_TRANSIENT as e:
+                # carry on from the last saved batch; that batch is re-sent, so don't count it twice
+                errors += 1
+                delay = min(BROADCAST_RETRY_MAX, 2 ** errors)
+                print(f"broadcast {job.id} error, retrying in {delay:.0f}s:", repr(e))
+                job.delivered, job.failed = committed
+                await asyncio.sleep(delay)
+                continue
 
-# ---------- START ----------
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    save_user(user)
+            if time.monotonic() - last_status >= BROADCAST_PROGRESS_INTERVAL:
+                last_status = time.monotonic()
+                await update_broadcast_status(bot, job)
 
-    # start with link: /start <owner_id>
-    if context.args:
-        if not await must_join(update, context):
-            return
+        await update_broadcast_status(bot, job, final=True)
+    except asyncio.CancelledError:
+        # shutdown: keep status 'running' so the next start resumes it. The
+        # unfinished batch is re-sent then, so don't count it twice.
+        job.delivered, job.failed = committed
+        try:
+            await save_broadcast_progress(job)
+        except Exception:
+            pass
+        raise
+    except Exception as e:
+        print("BROADCAST CRASH:", repr(e))
+        traceback.print_exc()
+        job.delivered, job.failed = committed
+        try:
+            await save_broadcast_progress(job, "failed")
+        except Exception:
+            pass
+        await update_broadcast_status(bot, job, final=True, failed=True)
+    finally:
+        running_broadcasts.pop(job.id, None)
 
-        owner_id = int(context.args[0])
-        if owner_id in blocked and user.id in blocked[owner_id]:
-            return
 
-        user_links[user.id] = owner_id
-        last_link_owner_for_user[user.id] = owner_id
-        await update.message.reply_text("پیامت رو بفرست ✉️")
-        return
+def launch_broadcast(bot, job: BroadcastJob):
+    running_broadcasts[job.id] = job
+    start_background(run_broadcast(bot, job))
 
-    if user.id in ADMIN_IDS:
-        await update.message.reply_text("🛠 پنل مدیریت", reply_markup=admin_menu())
-        return
 
-    if not await must_join(update, context):
-        return
+async def resume_broadcasts(bot):
+    rows = await q_all(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status='running' ORDER BY id")
+    for row in rows:
+        job = BroadcastJob(row)
+        if job.id not in running_broadcasts:
+            print(f"resuming broadcast {job.id} after user_id {job.last_user_id}")
+            launch_broadcast(bot, job)
 
-    await update.message.reply_text("سلام 👋", reply_markup=main_menu())
 
+# ---------- EXPORT ----------
+# Admins export users or messages, optionally for one user and/or a date
+# range, as gzip-compressed CSV or JSONL sent back as documents. Rows are
+# streamed from a server-side cursor (q_stream) EXPORT_CHUNK at a time and
+# written to a temp file from a worker thread, so memory stays flat however
+# many rows there are. Output is split into parts of EXPORT_PART_MB
+# (compressed; bots may upload at most 50 MB per file), each sent as soon as
+# it's full. The upload holds the whole part in memory, so parts are kept
+# small, and the file is read in a worker thread. Exports run in the background and aren't resumed after a restart.
+# Archived months aren't included: their MSG_ARCHIVE_DIR files are exports already.
+EXPORT_CHUNK = env_int("EXPORT_CHUNK", 5000)
+EXPORT_PART_MB = env_float("EXPORT_PART_MB", 8.0)
+EXPORT_PROGRESS_INTERVAL = env_float("EXPORT_PROGRESS_INTERVAL", 10.0)
+EXPORT_TABLES = {  # table -> (columns, time column, user filter)
+    "users": ("user_id, username, full_name, is_admin, last_seen", "last_seen", "user_id={p}"),
+    "messages": (MSG_COLUMNS, "ts", "(sender_id={p} OR receiver_id={p})"),
+}
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+EXPORT_HELP = (
+    "📦 چی رو خروجی بگیرم؟ یک خط بفرست:\n"
+    "users یا messages، بعد به دلخواه: آیدی عددی کاربر، تاریخ شروع و پایان "
+    "(YYYY-MM-DD به وقت UTC، هر دو روز شامل) و فرمت csv یا jsonl (پیش‌فرض csv).\n\n"
+    "مثال‌ها:\n"
+    "users\n"
+    "messages 123456789\n"
+    "messages 2024-01-01 2024-01-31 jsonl"
+)
 
-# ---------- BUTTONS ----------
-async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    qy = update.callback_query
-    await qy.answer()
-    uid = qy.from_user.id
 
-    # join check for normal users on usage actions
-    if uid not in ADMIN_IDS:
-        if qy.data in ("get_link", "send_direct", "send_again", "back_menu"):
-            if not await must_join(update, context):
-                return
+class ExportJob:
+    def __init__(self, admin_id: int, table: str, user_id: int | None, since: int | None,
+                 until: int | None, fmt: str):
+        self.admin_id = admin_id
+        self.table = table
+        self.user_id = user_id
+        self.since = since
+        self.until = until
+        self.fmt = fmt
+        self.rows = 0
+        self.parts = 0
+        self.status_message_id = None
+        self.started = time.monotonic()
 
-    if qy.data == "get_link":
-        link = f"https://t.me/{context.bot.username}?start={uid}"
-        await qy.message.reply_text(link)
-
-    elif qy.data == "send_direct":
-        send_direct_state.add(uid)
-        await qy.message.reply_text("آیدی عددی مخاطب رو بفرست:")
-
-    elif qy.data == "send_again":
-        # ✅ FIX: actually set state again
-        # If user previously used a link, re-enable link forwarding
-        if uid not in ADMIN_IDS:
-            owner = last_link_owner_for_user.get(uid) or get_last_owner_for_sender(uid)
-            if owner:
-                user_links[uid] = owner
-                last_link_owner_for_user[uid] = owner
-                await qy.message.reply_text("پیامت رو بفرست ✉️")
-            else:
-                await qy.message.reply_text("لینک اختصاصی قبلی پیدا نشد. دوباره از لینک وارد شو.")
-            return
+    def query(self) -> tuple[str, list]:
+        columns, ts_col, user_filter = EXPORT_TABLES[self.table]
+        p = "%s" if USING_PG else "?"
+        where, params = [], []
+        if self.user_id is not None:
+            where.append(user_filter.format(p=p))
+            params += [self.user_id] * user_filter.count("{p}")
+        if self.since is not None:
+            where.append(f"{ts_col} >= {p}")
+            params.append(self.since)
+        if self.until is not None:
+            where.append(f"{ts_col} < {p}")
+            params.append(self.until)
+        sql = f"SELECT {columns} FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return sql, params
+
+    def columns(self) -> list[str]:
+        return [c.strip() for c in EXPORT_TABLES[self.table][0].split(",")]
 
-        # For admin/owner: if they recently replied, set reply_state again
-        target = last_reply_target_for_owner.get(uid)
-        if target:
-            reply_state[uid] = target
-            await qy.message.reply_text("پاسخت رو بفرست ✉️")
+    def progress_text(self, final: bool = False) -> str:
+        head = "✅ خروجی آماده شد" if final else "📦 در حال خروجی گرفتن..."
+        return (
+            f"{head}\n"
+            f"جدول: {self.table} | فرمت: {self.fmt}.gz\n"
+            f"ردیف‌ها: {self.rows}\n"
+            f"فایل‌ها: {self.parts}\n"
+            f"⏱ {time.monotonic() - self.started:.0f} ثانیه"
+        )
+
+
+def parse_export_spec(admin_id: int, text: str) -> ExportJob | None:
+    words = text.split()
+    if not words or words[0].lower() not in EXPORT_TABLES:
+        return None
+    user_id, dates, fmt = None, [], "csv"
+    for w in words[1:]:
+        if w.isdigit() and user_id is None:
+            user_id = int(w)
+        elif EXPORT_DATE_RE.fullmatch(w) and len(dates) < 2:
+            try:
+                d = datetime.strptime(w, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            except ValueError:
+                return None
+            dates.append(int(d.timestamp()))
+        elif w.lower() in EXPORT_FORMATS:
+            fmt = w.lower()
         else:
-            await qy.message.reply_text("مخاطب قبلی برای پاسخ پیدا نشد.")
-        return
+            return None
+    since = dates[0] if dates else None
+    until = dates[1] + 86400 if len(dates) > 1 else None  # the end day is included
+    return ExportJob(admin_id, words[0].lower(), user_id, since, until, fmt)
 
-    elif qy.data == "back_menu":
-        user_links.pop(uid, None)
-        await qy.message.reply_text("منوی اصلی 👇", reply_markup=main_menu())
 
-    # -------- ADMIN --------
-    elif qy.data == "admin_stats":
-        if uid not in ADMIN_IDS:
-            return
-        q("SELECT COUNT(*) FROM users")
-        count = cur.fetchone()[0]
-        await qy.message.reply_text(f"👥 تعداد کاربران: {count}")
+class ExportPart:
+    """One compressed output file; every method runs in a worker thread."""
 
-    elif qy.data == "admin_latest_users":
-        if uid not in ADMIN_IDS:
-            return
-        if USING_PG:
-            q("SELECT user_id, full_name, username FROM users ORDER BY last_seen DESC NULLS LAST LIMIT 15")
+    def __init__(self, path: str, fmt: str, columns: list[str]):
+        self.path = path
+        self.fmt = fmt
+        self.columns = columns
+        self.raw = open(path, "wb")
+        self.gz = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        self.text = io.TextIOWrapper(self.gz, encoding="utf-8", newline="")
+        self.csv = None
+        if fmt == "csv":
+            self.csv = csv.writer(self.text)
+            self.csv.writerow(columns)
+
+    def write(self, rows) -> int:
+        """Appends rows; returns the compressed size so far."""
+        if self.csv is not None:
+            self.csv.writerows(rows)
         else:
-            q("SELECT user_id, full_name, username FROM users ORDER BY last_seen DESC LIMIT 15")
-        rows = cur.fetchall()
-        if not rows:
-            await qy.message.reply_text("هنوز کاربری ثبت نشده.")
-            return
-        lines = []
-        for user_id, full_name, username in rows:
-            name = full_name if full_name else "-"
-            uname = f"@{username}" if username else "-"
-            lines.append(f"👤 {name}\nID: {user_id}\nUsername: {uname}\n")
-        await qy.message.reply_text("🆕 ۱۵ کاربر آخر:\n\n" + "\n".join(lines))
-
-    elif qy.data == "admin_search":
-        if uid not in ADMIN_IDS:
-            return
-        admin_search_state.add(uid)
-        await qy.message.reply_text("آیدی عددی کاربر رو بفرست:")
+            self.text.writelines(
+                json.dumps(dict(zip(self.columns, r)), ensure_ascii=False) + "\n" for r in rows
+            )
+        self.text.flush()
+        return self.raw.tell()
 
-    elif qy.data == "admin_anon_send":
-        if uid not in ADMIN_IDS:
-            return
-        admin_anon_target_state.add(uid)
-        await qy.message.reply_text("آیدی عددی کاربر رو بفرست:")
+    def close(self):
+        self.text.close()  # closes the gzip stream too, which writes the trailer
+        self.raw.close()
 
-    elif qy.data == "admin_broadcast":
-        if uid not in ADMIN_IDS:
-            return
-        admin_broadcast_state.add(uid)
-        await qy.message.reply_text("پیام همگانی رو بفرست:")
 
-    elif qy.data == "admin_settings":
-        if uid not in ADMIN_IDS:
-            return
-        await qy.message.reply_text("⚙️ تنظیمات جوین اجباری", reply_markup=admin_settings_menu())
+running_exports = {}  # admin id -> ExportJob
 
-    elif qy.data == "toggle_force_join":
-        if uid not in ADMIN_IDS:
-            return
-        set_bool_setting("force_join_enabled", not get_bool_setting("force_join_enabled", False))
-        await qy.message.reply_text("✅ ذخیره شد.", reply_markup=admin_settings_menu())
 
-    elif qy.data == "set_force_join_channel":
-        if uid not in ADMIN_IDS:
-            return
-        admin_set_channel_state.add(uid)
-        await qy.message.reply_text("یوزرنیم کانال رو بفرست (مثل @mychannel) یا -100...:")
+def _read_part(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
 
-    elif qy.data == "set_force_join_link":
-        if uid not in ADMIN_IDS:
-            return
-        admin_set_link_state.add(uid)
-        await qy.message.reply_text("لینک کانال رو بفرست (مثل https://t.me/mychannel):")
 
-    elif qy.data == "back_admin":
-        if uid not in ADMIN_IDS:
-            return
-        await qy.message.reply_text("🛠 پنل مدیریت", reply_markup=admin_menu())
+async def send_export_part(bot, job: ExportJob, part: ExportPart, name: str):
+    await asyncio.to_thread(part.close)
+    job.parts += 1
+    data = await asyncio.to_thread(_read_part, part.path)
+    await bot.send_document(
+        chat_id=job.admin_id,
+        document=data,
+        filename=f"{name}_part{job.parts}.{job.fmt}.gz",
+        caption=f"📦 {job.table} — بخش {job.parts} (تا ردیف {job.rows})",
+        read_timeout=300,
+        write_timeout=300,
+    )
 
-    elif qy.data.startswith("reply_"):
-        target_sender = int(qy.data.split("_")[1])
 
-        # ✅ FIX: allow admin OR owner who received the message
-        owner_of_sender = last_owner_map.get(target_sender) or get_last_owner_for_sender(target_sender)
-        if uid not in ADMIN_IDS and uid != owner_of_sender:
-            await qy.message.reply_text("⛔️ اجازه نداری.")
-            return
+async def update_export_status(bot, job: ExportJob, final: bool = False):
+    try:
+        if final:
+            await bot.send_message(chat_id=job.admin_id, text=job.progress_text(final=True))
+        elif job.status_message_id:
+            await bot.edit_message_text(
+                chat_id=job.admin_id, message_id=job.status_message_id, text=job.progress_text()
+            )
+    except Exception:
+        pass
 
-        reply_state[uid] = target_sender
-        last_reply_target_for_owner[uid] = target_sender
-        await qy.message.reply_text("پاسخت رو بفرست:")
 
-    elif qy.data.startswith("block_"):
-        target_sender = int(qy.data.split("_")[1])
+async def run_export(bot, job: ExportJob):
+    workdir = tempfile.mkdtemp(prefix="export-")
+    name = f"{job.table}_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}"
+    part_limit = int(EXPORT_PART_MB * 1024 * 1024)
+    columns = job.columns()
+    last_status = time.monotonic()
+    part = None
+    try:
+        # rows still waiting in the write-behind buffers belong in the export
+        await message_log.flush()
+        await user_directory.flush()
+        sql, params = job.query()
+        async with aclosing(q_stream(sql, params, EXPORT_CHUNK)) as chunks:
+            async for rows in chunks:
+                if part is None:
+                    path = os.path.join(workdir, f"part{job.parts + 1}")
+                    part = await asyncio.to_thread(ExportPart, path, job.fmt, columns)
+                size = await asyncio.to_thread(part.write, rows)
+                job.rows += len(rows)
+                if size >= part_limit:
+                    await send_export_part(bot, job, part, name)
+                    os.remove(part.path)
+                    part = None
+                if time.monotonic() - last_status >= EXPORT_PROGRESS_INTERVAL:
+                    last_status = time.monotonic()
+                    await update_export_status(bot, job)
+        if part is not None:
+            await send_export_part(bot, job, part, name)
+            part = None
+        if job.rows == 0:
+            await bot.send_message(chat_id=job.admin_id, text="ردیفی با این شرایط پیدا نشد.")
+        else:
+            await update_export_status(bot, job, final=True)
+    except Exception as e:
+        print("EXPORT CRASH:", repr(e))
+        traceback.print_exc()
+        try:
+            await bot.send_message(chat_id=job.admin_id, text=f"❌ خروجی ناموفق بود: {e!r}")
+        except Exception:
+            pass
+    finally:
+        running_exports.pop(job.admin_id, None)
+        if part is not None:
+            try:
+                await asyncio.to_thread(part.close)
+            except Exception:
+                pass
+        await asyncio.to_thread(shutil.rmtree, workdir, True)
 
-        # ✅ FIX: allow admin OR owner who received the message
-        owner_of_sender = last_owner_map.get(target_sender) or get_last_owner_for_sender(target_sender)
-        if uid not in ADMIN_IDS and uid != owner_of_sender:
-            await qy.message.reply_text("⛔️ اجازه نداری.")
-            return
 
-        blocked.setdefault(uid, set()).add(target_sender)
-        await qy.message.reply_text("🚫 کاربر بلاک شد")
+def launch_export(bot, job: ExportJob):
+    running_exports[job.admin_id] = job
+    start_background(run_export(bot, job))
 
 
 # ---------- MESSAGE HANDLER ----------
+# Plain messages are dispatched on the sender's conversation mode (see
+# STATES) through message_routes; a message outside any mode is ignored.
+message_routes = {}  # mode -> (handler, admin_only)
+UNDELIVERED_TEXT = "❌ پیام به مقصد نرسید (ممکنه بات رو استاپ کرده باشه)."
+
+
+def on_message(mode: str, admin_only: bool = False):
+    def deco(fn):
+        message_routes[mode] = (fn, admin_only)
+        return fn
+    return deco
+
+
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
@@ -538,158 +3431,599 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await must_join(update, context):
             return
 
-    # admin set channel/link
-    if uid in ADMIN_IDS and uid in admin_set_channel_state:
-        admin_set_channel_state.remove(uid)
-        txt = (update.message.text or "").strip()
-        if not txt:
-            await update.message.reply_text("❌ مقدار معتبر نیست.")
+    async with user_state(uid) as st:
+        mode = st.mode
+        mark_branch(mode or "none")
+        route = message_routes.get(mode)
+        if route is None:
             return
-        set_setting("force_join_channel", txt)
-        await update.message.reply_text("✅ کانال ذخیره شد.", reply_markup=admin_settings_menu())
-        return
-
-    if uid in ADMIN_IDS and uid in admin_set_link_state:
-        admin_set_link_state.remove(uid)
-        txt = (update.message.text or "").strip()
-        if not txt:
-            await update.message.reply_text("❌ مقدار معتبر نیست.")
+        handler, admin_only = route
+        if admin_only and uid not in ADMIN_IDS:
             return
-        set_setting("force_join_link", txt)
-        await update.message.reply_text("✅ لینک ذخیره شد.", reply_markup=admin_settings_menu())
+        await handler(update, context, st)
+
+
+# admin set channel/link
+@on_message("admin_set_channel", admin_only=True)
+async def on_admin_set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.leave()
+    txt = (update.message.text or "").strip()
+    if not txt:
+        await update.message.reply_text("❌ مقدار معتبر نیست.")
         return
+    await set_setting("force_join_channel", txt)
+    await update.message.reply_text("✅ کانال ذخیره شد.", reply_markup=admin_settings_menu())
 
-    # admin anonymous send flow
-    if uid in ADMIN_IDS and uid in admin_anon_target_state:
-        txt = (update.message.text or "").strip()
-        if txt.isdigit():
-            admin_anon_target_state.remove(uid)
-            admin_anon_message_state[uid] = int(txt)
-            await update.message.reply_text("متن پیام ناشناس رو بفرست:")
-        else:
-            await update.message.reply_text("فقط آیدی عددی بفرست.")
+
+@on_message("admin_set_link", admin_only=True)
+async def on_admin_set_link(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.leave()
+    txt = (update.message.text or "").strip()
+    if not txt:
+        await update.message.reply_text("❌ مقدار معتبر نیست.")
         return
+    await set_setting("force_join_link", txt)
+    await update.message.reply_text("✅ لینک ذخیره شد.", reply_markup=admin_settings_menu())
 
-    if uid in ADMIN_IDS and uid in admin_anon_message_state:
-        target = admin_anon_message_state.pop(uid)
-        msg_text = extract_content(update)
-        try:
-            await context.bot.send_message(chat_id=target, text=msg_text)
-            save_message(uid, target, "admin_anonymous", msg_text)
-            await update.message.reply_text("✅ پیام ناشناس ارسال شد.", reply_markup=after_send_menu())
-        except Exception:
-            await update.message.reply_text("❌ ارسال نشد (ممکنه کاربر بات رو استاپ کرده باشه).")
+
+# admin anonymous send flow
+@on_message("admin_anon_target", admin_only=True)
+async def on_admin_anon_target(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    txt = (update.message.text or "").strip()
+    if txt.isdigit():
+        st.enter("admin_anon_message", int(txt))
+        await update.message.reply_text("متن پیام ناشناس رو بفرست:")
+    else:
+        await update.message.reply_text("فقط آیدی عددی بفرست.")
+
+
+@on_message("admin_anon_message", admin_only=True)
+async def on_admin_anon_message(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    _, target = st.leave()
+    uid = update.effective_user.id
+    msg_text = extract_content(update)
+    try:
+        await context.bot.send_message(chat_id=target, text=msg_text)
+        await save_message(uid, target, "admin_anonymous", msg_text)
+        await update.message.reply_text("✅ پیام ناشناس ارسال شد.", reply_markup=after_send_menu())
+    except Exception:
+        await update.message.reply_text("❌ ارسال نشد (ممکنه کاربر بات رو استاپ کرده باشه).")
+
+
+# admin search show content
+@on_message("admin_search", admin_only=True)
+async def on_admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    if not (update.message.text and update.message.text.isdigit()):
         return
+    st.leave()
+    target = int(update.message.text)
 
-    # admin search show content
-    if uid in admin_search_state and update.message.text and update.message.text.isdigit():
-        admin_search_state.remove(uid)
-        target = int(update.message.text)
+    await message_log.flush()
+    text, markup = await search_page(target, "o", SEARCH_CURSOR_MAX, SEARCH_CURSOR_MAX)
+    if text is None:
+        await update.message.reply_text("پیامی ثبت نشده")
+        return
+    await update.message.reply_text(text, reply_markup=markup)
 
-        if USING_PG:
-            q(
-                "SELECT sender_id, receiver_id, msg_type, content, ts FROM messages "
-                "WHERE sender_id=%s OR receiver_id=%s ORDER BY ts DESC LIMIT 50",
-                (target, target)
-            )
-        else:
-            q(
-                "SELECT sender_id, receiver_id, msg_type, content, ts FROM messages "
-                "WHERE sender_id=? OR receiver_id=? ORDER BY ts DESC LIMIT 50",
-                (target, target)
-            )
 
-        rows = cur.fetchall()
-        if not rows:
-            await update.message.reply_text("پیامی ثبت نشده")
-            return
+@on_message("admin_text_search", admin_only=True)
+async def on_admin_text_search(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    query = (update.message.text or "").strip()
+    if not fts_terms(query):
+        await update.message.reply_text("❌ یک کلمه برای جستجو بفرست.")
+        return
+    st.leave()
 
-        for sender_id, receiver_id, msg_type, content, ts in rows:
-            await update.message.reply_text(
-                f"📩 {ts}\nاز {sender_id} به {receiver_id}\nنوع: {msg_type}\nمحتوا: {content or '(بدون متن/فایل)'}"
-            )
+    await message_log.flush()
+    text, markup = await fts_page(remember_fts_query(query), 0)
+    if text is None:
+        await update.message.reply_text("نتیجه‌ای پیدا نشد.")
         return
+    await update.message.reply_text(text, reply_markup=markup)
 
-    # broadcast
-    if uid in admin_broadcast_state:
-        admin_broadcast_state.remove(uid)
-        q("SELECT user_id FROM users WHERE is_admin=0")
-        users = cur.fetchall()
-        for (u2,) in users:
-            try:
-                await context.bot.copy_message(
-                    chat_id=u2,
-                    from_chat_id=uid,
-                    message_id=update.message.message_id
-                )
-            except Exception:
-                pass
-        await update.message.reply_text("✅ پیام همگانی ارسال شد")
+
+# export (runs in the background, see run_export)
+@on_message("admin_export", admin_only=True)
+async def on_admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    uid = update.effective_user.id
+    job = parse_export_spec(uid, update.message.text or "")
+    if job is None:
+        await update.message.reply_text("❌ متوجه نشدم.\n\n" + EXPORT_HELP)
         return
+    st.leave()
+    if uid in running_exports:
+        await update.message.reply_text("⏳ یک خروجی دیگه در حال انجامه، صبر کن تموم بشه.")
+        return
+    status = await update.message.reply_text(job.progress_text())
+    job.status_message_id = status.message_id
+    launch_export(context.bot, job)
+
+
+# broadcast (runs in the background, see run_broadcast)
+@on_message("admin_broadcast", admin_only=True)
+async def on_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    st.leave()
+    uid = update.effective_user.id
+    job = await create_broadcast(uid, uid, update.message.message_id)
+    status = await update.message.reply_text(job.progress_text())
+    await set_broadcast_status_message(job, status.message_id)
+    launch_broadcast(context.bot, job)
+
 
-    # reply flow (admin OR owner)
-    if uid in reply_state:
-        target_sender = reply_state.pop(uid)
-        last_reply_target_for_owner[uid] = target_sender
+# reply flow (admin OR owner)
+@on_message("reply")
+async def on_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    _, target_sender = st.leave()
+    st.set("last_reply_target", target_sender)
+    uid = update.effective_user.id
 
-        await context.bot.copy_message(
+    # delivery and confirmation go out together
+    delivered, _ = await asyncio.gather(
+        context.bot.copy_message(
             chat_id=target_sender,
             from_chat_id=uid,
             message_id=update.message.message_id
-        )
-        save_message(uid, target_sender, "reply", extract_content(update))
-        await update.message.reply_text("✅ پاسخ ارسال شد", reply_markup=after_send_menu())
-        return
+        ),
+        update.message.reply_text("✅ پاسخ ارسال شد", reply_markup=after_send_menu()),
+        return_exceptions=True,
+    )
+    if isinstance(delivered, Exception):
+        await update.message.reply_text(UNDELIVERED_TEXT)
+        raise delivered
+    await save_message(uid, target_sender, "reply", extract_content(update))
 
-    # send_direct flow (simple)
-    if uid in send_direct_state:
-        if update.message.text and update.message.text.isdigit():
-            target = int(update.message.text)
-            send_direct_state.remove(uid)
-            # store in reply_state-like temporary to send next message
-            reply_state[uid] = target
-            last_reply_target_for_owner[uid] = target
-            await update.message.reply_text("پیامت رو بفرست:")
-        else:
-            await update.message.reply_text("فقط آیدی عددی بفرست.")
-        return
 
-    # user via link -> forward to owner
-    if uid in user_links:
-        owner = user_links[uid]
+# send_direct flow (simple)
+@on_message("direct")
+async def on_direct(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    if update.message.text and update.message.text.isdigit():
+        target = int(update.message.text)
+        # store in reply-like temporary state to send next message
+        st.enter("reply", target)
+        st.set("last_reply_target", target)
+        await update.message.reply_text("پیامت رو بفرست:")
+    else:
+        await update.message.reply_text("فقط آیدی عددی بفرست.")
 
-        # blocked check
-        if owner in blocked and uid in blocked[owner]:
-            return
 
+# user via link -> forward to owner
+@on_message("link")
+async def on_link(update: Update, context: ContextTypes.DEFAULT_TYPE, st: UserState):
+    user = update.effective_user
+    uid = user.id
+    owner = st.mode_arg
+
+    # blocked check
+    if is_blocked(owner, uid):
+        return
+    # the owner's inbox limit; only messages that really get forwarded count
+    if uid not in ADMIN_IDS and not flood.admit_link(uid, owner, update.message):
+        await flood_drop(update, uid, "owner")
+        return
+
+    async def notify_owner():
+        # in this order, so the sender card follows the forwarded message
         await context.bot.forward_message(
             chat_id=owner,
             from_chat_id=uid,
             message_id=update.message.message_id
         )
-
         await context.bot.send_message(
             chat_id=owner,
             text=f"👤 فرستنده:\nID: {uid}\nUsername: @{user.username}",
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("✉️ پاسخ", callback_data=f"reply_{uid}"),
-                    InlineKeyboardButton("🚫 بلاک", callback_data=f"block_{uid}")
-                ]
-            ])
+            reply_markup=sender_buttons(uid, owner)
         )
 
-        save_message(uid, owner, "forward", extract_content(update))
+    # the owner's messages and the sender's confirmation go out together
+    delivered, _ = await asyncio.gather(
+        notify_owner(),
+        update.message.reply_text("✅ پیام ارسال شد", reply_markup=after_send_menu()),
+        return_exceptions=True,
+    )
+    if isinstance(delivered, Exception):
+        await update.message.reply_text(UNDELIVERED_TEXT)
+        raise delivered
+
+    await save_message(uid, owner, "forward", extract_content(update))
+
+    # ✅ remember mapping for permission + send_again
+    st.set("last_owner", owner)
+    st.set("last_link_owner", owner)
+
+    # we end this one-shot session (like your original logic)
+    st.leave()
+
+
+# ---------- CONCURRENCY ----------
+# Updates are processed concurrently (UPDATE_WORKERS at a time), but each
+# user's updates still run one after another: handlers are wrapped in
+# per_user(), which holds that user's lock for the whole handler. The state
+# load -> change -> save sequence in message_handler/buttons can't interleave
+# for one user, while unrelated users proceed in parallel. asyncio.Lock wakes
+# waiters FIFO, so a user's updates keep their arrival order.
+# The UPDATE_WORKERS limit is a semaphore taken only once the user's lock is
+# held: PTB's own bound (UPDATE_PENDING) is set much higher, so updates queued
+# behind a busy user wait on that user's lock without occupying a worker
+# slot that other users need.
+UPDATE_WORKERS = env_int("UPDATE_WORKERS", 32)
+UPDATE_PENDING = env_int("UPDATE_PENDING", 4096)  # updates PTB keeps in flight, mostly waiting
+
+
+class KeyedLocks:
+    def __init__(self):
+        self._locks = {}  # key -> [asyncio.Lock, holders + waiters]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+user_locks = KeyedLocks()
+update_slots = asyncio.Semaphore(UPDATE_WORKERS)
+
+
+class WorkerSlot:
+    """The update_slots permit of one running handler."""
+    busy = 0  # permits held right now, all slots
+
+    def __init__(self):
+        self.held = False
+        self.done = False
+        self.away = 0  # worker_idle() blocks the handler's tasks are in
+
+    async def take(self):
+        await update_slots.acquire()
+        self.held = True
+        WorkerSlot.busy += 1
+
+    def give_back(self):
+        if self.held:
+            self.held = False
+            WorkerSlot.busy -= 1
+            update_slots.release()
+
+    @asynccontextmanager
+    async def idle(self):
+        # a handler's gather()ed sends share the slot: the first one to wait
+        # gives it up, the last one back takes it again
+        self.away += 1
+        if self.away == 1:
+            self.give_back()
+        try:
+            yield
+        finally:
+            self.away -= 1
+            if self.away == 0 and not self.done and not self.held:
+                await self.take()
+
+
+_worker_slot = contextvars.ContextVar("worker_slot", default=None)
+
 
-        # ✅ remember mapping for permission + send_again
-        last_owner_map[uid] = owner
-        last_link_owner_for_user[uid] = owner
+@asynccontextmanager
+async def worker_idle():
+    """Let other updates use this handler's worker slot while it only waits."""
+    slot = _worker_slot.get()
+    if slot is None:
+        yield
+        return
+    async with slot.idle():
+        yield
+
+
+def per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        slot = WorkerSlot()
+        token = _worker_slot.set(slot)
+        try:
+            if user is None:
+                await slot.take()
+                return await handler(update, context)
+            async with user_locks.hold(user.id):
+                await slot.take()
+                return await handler(update, context)
+        finally:
+            slot.done = True
+            slot.give_back()
+            _worker_slot.reset(token)
+    return wrapper
+
+
+# ---------- FLOOD CONTROL ----------
+# flood_guard runs in handler group -1, before save_user, must_join or any
+# handler, and only touches memory. Each user gets a token bucket of
+# FLOOD_USER_RATE updates/s (burst FLOOD_USER_BURST). An album arrives as
+# one update per item; only its first item spends a token, so a full album
+# (FLOOD_ALBUM_MAX items) gets through like a single message. Excess updates
+# are dropped (ApplicationHandlerStop).
+# Each owner's inbox has its own limit too, so many accounts can't flood it:
+# FLOOD_OWNER_RATE/s (burst FLOOD_OWNER_BURST), split evenly between the
+# senders that used it in the last FLOOD_OWNER_ACTIVE seconds. Each forwarded
+# message is two sends to the owner's chat, so this defaults to half of that
+# chat's outbox rate and burst. on_link checks it with admit_link() right
+# before forwarding. Messages that won't be forwarded (not in link mode,
+# blocked by the owner) never count, and a sender over its share keeps link
+# mode to try again later.
+# A sender gets at most one warning per FLOOD_WARN_INTERVAL. Admins are never
+# limited. A rate of 0 turns that limit off.
+FLOOD_USER_RATE = env_float("FLOOD_USER_RATE", 1.0)
+FLOOD_USER_BURST = env_float("FLOOD_USER_BURST", 8.0)
+FLOOD_OWNER_RATE = env_float("FLOOD_OWNER_RATE", OUTBOX_CHAT_RATE / 2)
+FLOOD_OWNER_BURST = env_float("FLOOD_OWNER_BURST", max(1.0, OUTBOX_CHAT_BURST / 2))
+FLOOD_OWNER_ACTIVE = env_float("FLOOD_OWNER_ACTIVE", 60.0)
+FLOOD_WARN_INTERVAL = env_float("FLOOD_WARN_INTERVAL", 60.0)
+FLOOD_TRACKED = env_int("FLOOD_TRACKED", 100000)  # entries per table, LRU
+FLOOD_ALBUM_MAX = 10  # items Telegram allows in one album
+FLOOD_WARNINGS = {
+    "user": "⏳ خیلی سریع پیام می‌فرستی، چند لحظه صبر کن.",
+    "owner": "⏳ این کاربر الان پیام‌های زیادی دریافت می‌کنه، کمی بعد دوباره امتحان کن.",
+}
+metrics.describe("bot_flood_dropped_total", "counter", "Updates dropped by the flood limiter, by limit")
+metrics.describe("bot_flood_warnings_total", "counter", "Flood warnings sent, by limit")
+
+
+def _lru_put(table: OrderedDict, key, value):
+    table[key] = value
+    table.move_to_end(key)
+    if len(table) > FLOOD_TRACKED:
+        table.popitem(last=False)
+
+
+class FloodGuard:
+    def __init__(self):
+        self.users = OrderedDict()   # user_id -> TokenBucket
+        self.owners = OrderedDict()  # owner_id -> OrderedDict(sender_id -> (TokenBucket, last admitted))
+        self.warned = OrderedDict()  # user_id -> when the last warning went out
+        self.albums = OrderedDict()  # user_id -> (media_group_id, items seen)
+
+    @staticmethod
+    def _take(table: OrderedDict, key: int, rate: float, burst: float) -> bool:
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        _lru_put(table, key, bucket)
+        return bucket.try_acquire()
+
+    def _album_rest(self, uid: int, msg) -> bool:
+        """True for the 2nd..FLOOD_ALBUM_MAX-th item of the album the user is sending."""
+        if msg is None or not msg.media_group_id:
+            return False
+        seen = self.albums.get(uid)
+        if seen is not None and seen[0] == msg.media_group_id and seen[1] < FLOOD_ALBUM_MAX:
+            _lru_put(self.albums, uid, (seen[0], seen[1] + 1))
+            return True
+        _lru_put(self.albums, uid, (msg.media_group_id, 1))
+        return False
+
+    def check(self, update: Update, uid: int) -> str | None:
+        """None to let the update through, else the limit it hit."""
+        if self._album_rest(uid, update.message):
+            return None
+        if FLOOD_USER_RATE > 0 and not self._take(self.users, uid, FLOOD_USER_RATE, FLOOD_USER_BURST):
+            return "user"
+        return None
+
+    def admit_link(self, uid: int, owner_id: int, msg) -> bool:
+        """Whether uid's message may be forwarded to owner_id now (their fair share of the owner's limit)."""
+        if FLOOD_OWNER_RATE <= 0 or uid == owner_id:
+            return True
+        seen = self.albums.get(uid)
+        if msg is not None and msg.media_group_id and seen and seen[0] == msg.media_group_id and seen[1] > 1:
+            return True
+        now = time.monotonic()
+        senders = self.owners.get(owner_id)
+        if senders is None:
+            senders = OrderedDict()
+        _lru_put(self.owners, owner_id, senders)
+        while senders:  # least recently admitted first
+            oldest, (_, last) = next(iter(senders.items()))
+            if now - last <= FLOOD_OWNER_ACTIVE or oldest == uid:
+                break
+            del senders[oldest]
+        entry = senders.get(uid)
+        n = len(senders) + (entry is None)
+        rate, burst = FLOOD_OWNER_RATE / n, max(1.0, FLOOD_OWNER_BURST / n)
+        if entry is None:
+            bucket = TokenBucket(rate, burst)
+        else:
+            bucket = entry[0]
+            bucket.rate, bucket.capacity = rate, burst
+        if not bucket.try_acquire():
+            senders[uid] = (bucket, entry[1] if entry else now)
+            return False
+        senders.pop(uid, None)
+        _lru_put(senders, uid, (bucket, now))
+        return True
+
+    def should_warn(self, uid: int) -> bool:
+        now = time.monotonic()
+        last = self.warned.get(uid)
+        if last is not None and now - last < FLOOD_WARN_INTERVAL:
+            return False
+        _lru_put(self.warned, uid, now)
+        return True
+
+
+flood = FloodGuard()
 
-        # we end this one-shot session (like your original logic)
-        user_links.pop(uid, None)
 
-        await update.message.reply_text("✅ پیام ارسال شد", reply_markup=after_send_menu())
+async def flood_drop(update: Update, uid: int, scope: str):
+    metrics.inc("bot_flood_dropped_total", (("limit", scope),))
+    if not flood.should_warn(uid):
+        return
+    metrics.inc("bot_flood_warnings_total", (("limit", scope),))
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(FLOOD_WARNINGS[scope], show_alert=True)
+        elif update.effective_message:
+            await update.effective_message.reply_text(FLOOD_WARNINGS[scope])
+    except Exception:
+        pass
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None or user.id in ADMIN_IDS:
+        return
+    scope = flood.check(update, user.id)
+    if scope is None:
         return
+    await flood_drop(update, user.id, scope)
+    raise ApplicationHandlerStop
+
+
+# ---------- METRIC GAUGES ----------
+metrics.gauge("bot_state_entries", "Entries in the conversation state store", lambda: state_store.size())
+metrics.gauge("bot_user_locks", "Users with an update in flight or queued", lambda: len(user_locks))
+metrics.gauge("bot_update_workers_busy", "Worker slots held by running handlers", lambda: WorkerSlot.busy)
+metrics.gauge("bot_membership_cache_entries", "Entries in the force-join membership cache",
+              lambda: membership_cache.stats()["size"])
+metrics.counter("bot_membership_cache_lookups_total", "Force-join membership cache lookups, by result",
+                lambda: [((("result", "hit"),), membership_cache.hits), ((("result", "miss"),), membership_cache.misses)])
+metrics.counter("bot_membership_cache_evictions_total", "Force-join membership cache evictions",
+                lambda: membership_cache.evictions)
+metrics.gauge("bot_blocks", "Block pairs held in memory", lambda: len(block_index))
+metrics.gauge("bot_blocks_bytes", "Memory used by the block index", lambda: block_index.nbytes())
+metrics.gauge("bot_users_pending", "User upserts waiting for the next flush", lambda: user_directory.pending())
+metrics.gauge("bot_users_cached", "Users whose last written row is remembered", lambda: user_directory.cached())
+metrics.gauge("bot_messages_pending", "Message log rows waiting to be written", lambda: message_log.pending())
+metrics.counter("bot_messages_written_total", "Message log rows written", lambda: message_log.written)
+metrics.counter("bot_messages_dropped_total", "Message log rows given up on at shutdown", lambda: message_log.dropped)
+metrics.gauge("bot_outbox_waiting", "Sends waiting for a rate limit slot, by class",
+              lambda: [((("class", k),), v) for k, v in outbox.waiting.items()])
+metrics.gauge("bot_outbox_chats", "Chats with a live outbox lane", lambda: len(outbox.chats))
+metrics.gauge("bot_message_partitions", "Message partitions in the DB and in archive files",
+              lambda: [((("where", "db"),), len(partitions)), ((("where", "archive"),), len(archives))])
+metrics.gauge("bot_broadcast_done", "Recipients processed by running broadcasts",
+              lambda: [((("id", j.id),), j.delivered + j.failed) for j in running_broadcasts.values()])
+metrics.gauge("bot_broadcast_total", "Recipients targeted by running broadcasts",
+              lambda: [((("id", j.id),), j.total) for j in running_broadcasts.values()])
+metrics.gauge("bot_export_rows", "Rows written by running exports, by admin",
+              lambda: [((("admin", j.admin_id),), j.rows) for j in running_exports.values()])
+metrics.gauge("bot_flood_tracked", "Users and owners tracked by the flood limiter",
+              lambda: [((("table", "users"),), len(flood.users)), ((("table", "owners"),), len(flood.owners))])
+metrics.gauge("bot_ready", "1 while the bot is started and serving updates", lambda: int(health.ready))
+metrics.counter("bot_restarts_total", "Bot loop restarts since the process started", lambda: health.restarts)
+metrics.gauge("bot_startup_step_seconds", "Duration of each step of the last startup",
+              lambda: [((("step", name),), dt) for name, dt in health.steps])
+metrics.gauge("bot_broadcast_rate", "Send rate of running broadcasts (messages/s)",
+              lambda: [((("id", j.id),), round(j.rate(), 2)) for j in running_broadcasts.values()])
+
+
+# ---------- HEALTH ----------
+# Importing this module is cheap: the token, the DB connection, migrations and
+# caches are all set up by post_init() when the application starts, one timed
+# step at a time. web.py serves two probes from what's recorded here:
+#   /healthz  liveness, always 200: uptime, restarts, last poll/update, DB check
+#   /readyz   200 only while the bot can serve updates: started, DB answering,
+#             and (polling) getUpdates succeeded within POLL_TIMEOUT + grace
+# Point the host's health check at /readyz.
+READY_POLL_GRACE = env_float("READY_POLL_GRACE", 30.0)
+HEALTH_DB_TIMEOUT = env_float("HEALTH_DB_TIMEOUT", 2.0)
+
+
+class Health:
+    def __init__(self):
+        self.booted_at = time.time()
+        self.started_at = 0.0      # end of the last successful startup
+        self.ready = False
+        self.starts = 0            # startup attempts
+        self.restarts = 0          # bot loop crashes (run_bot)
+        self.last_error = ""
+        self.last_poll_at = 0.0    # last successful getUpdates
+        self.last_update_at = 0.0  # last update that reached a handler
+        self.steps = []            # (step, seconds) of the last startup
+        self.loop = None           # the bot's event loop, for DB checks from web threads
+
+    def starting(self):
+        self.ready = False
+        self.starts += 1
+        self.steps = []
+
+    def started(self, loop):
+        self.loop = loop
+        self.started_at = time.time()
+        self.ready = True
+
+    def restarted(self, error: Exception):
+        self.ready = False
+        self.restarts += 1
+        self.last_error = repr(error)
+
+
+health = Health()
+
+
+@asynccontextmanager
+async def startup_step(name: str):
+    t0 = time.monotonic()
+    yield
+    dt = time.monotonic() - t0
+    health.steps.append((name, round(dt, 3)))
+    print(f"startup: {name} {dt:.2f}s")
+
+
+async def db_ping():
+    await q_one("SELECT 1")
+
+
+def check_db() -> str:
+    """"ok" or what went wrong. Runs db_ping() on the bot's loop: call it from another thread."""
+    loop = health.loop
+    if loop is None or not health.ready:
+        return "not started"
+    fut = asyncio.run_coroutine_threadsafe(db_ping(), loop)
+    try:
+        fut.result(HEALTH_DB_TIMEOUT)
+    except Exception as e:
+        fut.cancel()
+        return repr(e)
+    return "ok"
+
+
+def health_report() -> tuple[bool, dict]:
+    """(ready, report) for the web probes."""
+    now = time.time()
+
+    def ago(ts):
+        return round(now - ts, 1) if ts else None
+
+    db_status = check_db()
+    problems = []
+    if not health.ready:
+        problems.append("not started")
+    elif db_status != "ok":
+        problems.append("db")
+    elif BOT_MODE != "webhook" and now - max(health.last_poll_at, health.started_at) > POLL_TIMEOUT + READY_POLL_GRACE:
+        problems.append("polling stalled")
+    return not problems, {
+        "ready": not problems,
+        "problems": problems,
+        "mode": BOT_MODE,
+        "db": db_status,
+        "uptime_s": round(now - health.booted_at, 1),
+        "starts": health.starts,
+        "restarts": health.restarts,
+        "last_error": health.last_error,
+        "last_poll_s_ago": ago(health.last_poll_at),
+        "last_update_s_ago": ago(health.last_update_at),
+        "startup_steps": dict(health.steps),
+    }
 
 
 # ---------- PTB ERROR HANDLER ----------
@@ -698,29 +4032,208 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     traceback.print_exc()
 
 
+# ---------- APP LIFECYCLE ----------
+background_tasks = []
+
+
+def start_background(coro):
+    # a fresh context: a job started from a handler must not inherit its worker slot
+    task = asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+    background_tasks.append(task)
+    return task
+
+
+async def stop_background():
+    while background_tasks:
+        task = background_tasks.pop()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print("background task error:", repr(e))
+
+
+async def post_init(app):
+    """The startup phase: nothing below runs at import time."""
+    health.starting()
+    t0 = time.monotonic()
+    async with startup_step("db_open"):
+        await db_open()
+    async with startup_step("migrations"):
+        await run_migrations()
+    async with startup_step("settings"):
+        await load_settings()
+        await seed_settings()
+    async with startup_step("partitions"):
+        await load_partitions()
+        await ensure_partition(now_ts())
+    async with startup_step("blocks"):
+        await load_blocks()
+    async with startup_step("broadcasts"):
+        await resume_broadcasts(app.bot)
+
+    start_background(partition_maintainer())
+    start_background(state_purger())
+    if BLOCKS_TTL > 0:
+        start_background(blocks_refresher())
+    message_log.start()
+    start_background(user_flusher())
+    if SETTINGS_TTL > 0:
+        start_background(settings_refresher())
+    health.started(asyncio.get_running_loop())
+    print(f"startup done in {time.monotonic() - t0:.2f}s")
+
+
+async def post_shutdown(app):
+    health.ready = False
+    await stop_background()
+    await message_log.stop()
+    try:
+        await user_directory.flush()
+    except Exception as e:
+        print("user flush on shutdown failed:", repr(e))
+    await db_close()
+
+
 # ---------- MAIN (RECONNECT SAFE) ----------
-def run_bot():
-    while True:
+# BOT_MODE=polling (default): long-poll getUpdates from run_bot().
+# BOT_MODE=webhook: web.py serves WEBHOOK_PATH and feeds updates into the
+# application via run_webhook(). Telegram is told to send updates to
+# WEBHOOK_URL + WEBHOOK_PATH; leave WEBHOOK_URL empty to test locally by
+# POSTing update JSON yourself. WEBHOOK_SECRET is checked against the
+# X-Telegram-Bot-Api-Secret-Token header and is required once WEBHOOK_URL
+# is set: only the local-testing setup may accept unauthenticated updates.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram").strip() or "/telegram"
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip()
+POLL_TIMEOUT = env_int("POLL_TIMEOUT", 30)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the real transport and records Bot API latency/errors per method."""
+
+    def __init__(self, inner: BaseRequest):
+        self._inner = inner
+
+    async def initialize(self):
+        await self._inner.initialize()
+
+    async def shutdown(self):
+        await self._inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        labels = (("method", api_method),)
+        t0 = time.perf_counter()
         try:
-            app = (
-                ApplicationBuilder()
-                .token(TOKEN)
-                .connect_timeout(30)
-                .read_timeout(90)
-                .write_timeout(90)
-                .pool_timeout(30)
-                .build()
+            code, payload = await self._inner.do_request(
+                url, method, request_data,
+                read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
             )
-            app.add_handler(CommandHandler("start", start))
-            app.add_handler(CallbackQueryHandler(buttons))
-            app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, message_handler))
-            app.add_error_handler(on_error)
+        except Exception as e:
+            metrics.inc("bot_telegram_api_errors_total", labels + (("status", type(e).__name__),))
+            raise
+        finally:
+            metrics.observe("bot_telegram_api_seconds", labels, time.perf_counter() - t0)
+        if code >= 400:
+            metrics.inc("bot_telegram_api_errors_total", labels + (("status", code),))
+        elif api_method == "getUpdates":
+            health.last_poll_at = time.time()
+        return code, payload
+
 
-            app.run_polling(drop_pending_updates=True, close_loop=False, poll_interval=1.0)
+def api_request(pool_size: int, transport=None) -> BaseRequest:
+    """transport(pool_size) -> BaseRequest replaces the HTTP client (bench.py uses a fake Bot API)."""
+    if transport is not None:
+        return InstrumentedRequest(transport(pool_size))
+    return InstrumentedRequest(HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=30,
+        read_timeout=90,
+        write_timeout=90,
+        pool_timeout=30,
+    ))
+
+
+def build_app(polling: bool = True, transport=None):
+    builder = (
+        ApplicationBuilder()
+        .token(bot_token())
+        .request(api_request(256, transport))
+        .get_updates_request(api_request(1, transport))
+        .rate_limiter(outbox)
+        .concurrent_updates(UPDATE_PENDING)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    app.add_handler(CommandHandler("start", per_user(timed_handler("start")(start))))
+    app.add_handler(CallbackQueryHandler(per_user(timed_handler("buttons")(buttons))))
+    app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, per_user(timed_handler("message")(message_handler))))
+    app.add_error_handler(on_error)
+    return app
+
+
+def run_bot():
+    while True:
+        try:
+            app = build_app()
+            # long polling: getUpdates returns as soon as an update arrives
+            app.run_polling(drop_pending_updates=True, close_loop=False, poll_interval=0.0, timeout=POLL_TIMEOUT)
 
         except NetworkError as e:
             print("NetworkError, reconnecting...", repr(e))
+            health.restarted(e)
             time.sleep(5)
         except Exception as e:
             print("BOT LOOP CRASH:", repr(e))
+            health.restarted(e)
             time.sleep(5)
+
+
+webhook_app = None  # the running Application in webhook mode
+
+
+async def feed_webhook_update(data: dict) -> bool:
+    """Queue one update received over HTTP. False if the bot isn't running."""
+    app = webhook_app
+    if app is None or not app.running:
+        return False
+    await app.update_queue.put(Update.de_json(data, app.bot))
+    return True
+
+
+async def run_webhook(serve):
+    """Run the bot in webhook mode for as long as the awaitable serve() (the HTTP server) runs."""
+    global webhook_app
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET must be set when WEBHOOK_URL is set")
+    app = build_app(polling=False)
+    await app.initialize()
+    try:
+        await post_init(app)
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=True,
+            )
+        await app.start()
+        webhook_app = app
+        try:
+            await serve()
+        finally:
+            webhook_app = None
+            await app.stop()
+    finally:
+        await app.shutdown()
+        await post_shutdown(app)
@@ -0,0 +1,290 @@
+"""Offline benchmark: runs MKQ55596 against a fake Bot API.
+
+    python bench.py                       # temporary SQLite database
+    python bench.py --db postgresql://...  # local Postgres (use a scratch database)
+    python bench.py --users 500 --latency 40 --only link,reply --json out.json
+
+Synthetic update streams go through the real handlers (build_app, per-user
+locks, state store, write-behind logs). Bot API calls never leave the
+process: FakeBotAPI records them and answers after --latency ms. For each
+scenario the report shows updates/s, p50/p99 handler latency, and DB
+queries and Bot API calls per update.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from telegram.request import BaseRequest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("link", "reply", "callbacks", "search", "broadcast")
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls locally with plausible results."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = {}
+        self._ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if self.latency and api != "getUpdates":
+            await asyncio.sleep(self.latency)
+
+        if api == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif api == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "u"}}
+        elif api in ("sendMessage", "forwardMessage", "editMessageText", "sendDocument"):
+            result = {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": str(params.get("text", "")),
+            }
+        elif api == "copyMessage":
+            result = {"message_id": next(self._ids)}
+        elif api == "getUpdates":
+            result = []
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class Updates:
+    """Builds update payloads the way Telegram would send them."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+    def message(self, uid: int, text: str) -> dict:
+        msg = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+            "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": msg}
+
+    def callback(self, uid: int, data: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._message_ids)),
+                "chat_instance": "bench",
+                "data": data,
+                "from": self._user(uid),
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "text": "-",
+                },
+            },
+        }
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def db_queries(M) -> int:
+    _, hists = M.metrics.snapshot()
+    return sum(h[-2] for (name, _), h in hists.items() if name == "bot_db_query_seconds")
+
+
+async def replay(M, app, api, scripts, concurrency: int) -> dict:
+    """Run scripts (lists of updates) concurrently; each script's updates run in order."""
+    latencies = []
+    pending = iter(scripts)
+
+    async def worker():
+        for script in pending:
+            for data in script:
+                update = M.Update.de_json(data, app.bot)
+                t0 = time.perf_counter()
+                await app.process_update(update)
+                latencies.append(time.perf_counter() - t0)
+
+    q0, c0 = db_queries(M), api.total()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    # write-behind work is part of the cost of these updates
+    await M.message_log.flush()
+    await M.user_directory.flush()
+    elapsed = time.perf_counter() - t0
+    n = len(latencies)
+    return {
+        "updates": n,
+        "seconds": round(elapsed, 3),
+        "updates_per_s": round(n / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "queries_per_update": round((db_queries(M) - q0) / n, 2) if n else 0.0,
+        "api_calls_per_update": round((api.total() - c0) / n, 2) if n else 0.0,
+    }
+
+
+async def run_broadcast_scenario(M, app, api, u: Updates, admin: int) -> dict:
+    q0, c0 = db_queries(M), api.total()
+    t0 = time.perf_counter()
+    await app.process_update(M.Update.de_json(u.callback(admin, "admin_broadcast"), app.bot))
+    await app.process_update(M.Update.de_json(u.message(admin, "bench broadcast"), app.bot))
+    while M.running_broadcasts:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - t0
+    row = (await M.q_one("SELECT delivered, failed FROM broadcasts ORDER BY id DESC LIMIT 1")) or (0, 0)
+    sent = row[0] + row[1]
+    return {
+        "updates": 2,
+        "seconds": round(elapsed, 3),
+        "recipients": sent,
+        "recipients_per_s": round(sent / elapsed, 1) if elapsed else 0.0,
+        "queries_per_recipient": round((db_queries(M) - q0) / sent, 3) if sent else 0.0,
+        "api_calls_per_recipient": round((api.total() - c0) / sent, 3) if sent else 0.0,
+    }
+
+
+async def bench(M, args) -> dict:
+    api = FakeBotAPI(args.latency / 1000)
+    app = M.build_app(polling=False, transport=lambda pool_size: api)
+    u = Updates()
+    admin = next(iter(M.ADMIN_IDS))
+    owners = [10_000_000 + i for i in range(max(1, args.users // 10))]
+    senders = [20_000_000 + i for i in range(args.users)]
+    only = set(args.only.split(",")) if args.only else set(SCENARIOS)
+    results = {}
+
+    await app.initialize()
+    try:
+        await M.post_init(app)
+        await app.start()
+
+        # link: /start <owner> then one message, forwarded to the owner
+        scripts = []
+        for i, sender in enumerate(senders):
+            owner = owners[i % len(owners)]
+            script = []
+            for r in range(args.rounds):
+                script += [u.message(sender, f"/start {owner}"), u.message(sender, f"hello {r}")]
+            scripts.append(script)
+        if "link" in only or only & {"reply", "search"}:
+            results["link"] = await replay(M, app, api, scripts, args.concurrency)
+
+        # reply: each owner presses the signed reply button and answers, sender by sender
+        if "reply" in only:
+            scripts = {owner: [] for owner in owners}
+            for i, sender in enumerate(senders):
+                owner = owners[i % len(owners)]
+                scripts[owner] += [u.callback(owner, M.sign_callback("r", sender, owner)), u.message(owner, "answer")]
+            scripts = list(scripts.values())
+            results["reply"] = await replay(M, app, api, scripts, args.concurrency)
+
+        # callbacks: menu buttons that don't change much
+        if "callbacks" in only:
+            scripts = [
+                [u.callback(sender, "get_link"), u.callback(sender, "send_again"), u.callback(sender, "back_menu")]
+                for sender in senders
+            ]
+            results["callbacks"] = await replay(M, app, api, scripts, args.concurrency)
+
+        # search: admin opens the message history of an owner
+        if "search" in only:
+            scripts = [
+                [u.callback(admin, "admin_search"), u.message(admin, str(owners[i % len(owners)]))]
+                for i in range(args.searches)
+            ]
+            results["search"] = await replay(M, app, api, scripts, 1)
+
+        if "broadcast" in only:
+            results["broadcast"] = await run_broadcast_scenario(M, app, api, u, admin)
+    finally:
+        if app.running:
+            await app.stop()
+        await M.post_shutdown(app)
+        await app.shutdown()
+
+    results["_api_calls"] = dict(sorted(api.calls.items()))
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default="", help="Postgres URL; default is a temporary SQLite file")
+    ap.add_argument("--users", type=int, default=200, help="distinct senders (owners = users / 10)")
+    ap.add_argument("--rounds", type=int, default=3, help="link messages per sender")
+    ap.add_argument("--searches", type=int, default=50, help="admin searches to run")
+    ap.add_argument("--concurrency", type=int, default=32, help="updates in flight")
+    ap.add_argument("--latency", type=float, default=0.0, help="fake Bot API latency in ms")
+    ap.add_argument("--broadcast-rate", type=float, default=0.0, help="override BROADCAST_RATE (msgs/s)")
+    ap.add_argument("--telegram-limits", action="store_true",
+                    help="keep the outbox's Telegram rate limits (off by default: measure the bot itself)")
+    ap.add_argument("--flood-limits", action="store_true",
+                    help="keep the inbound flood limiter (off by default: scripts send faster than any user)")
+    ap.add_argument("--only", default="", help="comma-separated subset of: " + ",".join(SCENARIOS))
+    ap.add_argument("--json", default="", help="also write results to this file")
+    args = ap.parse_args()
+
+    # Configure the module before importing it: it reads token/DB settings
+    # at import time, and a database.txt in the working directory would win
+    # over an empty DATABASE_URL, so run from a scratch directory.
+    out = os.path.abspath(args.json) if args.json else ""
+    work = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(work)
+    sys.path.insert(0, HERE)
+    os.environ["BOT_TOKEN"] = "123456:bench"
+    os.environ["DATABASE_URL"] = args.db
+    os.environ["SQLITE_PATH"] = os.path.join(work, "bench.db")
+    if args.broadcast_rate:
+        os.environ["BROADCAST_RATE"] = str(args.broadcast_rate)
+    if not args.telegram_limits:
+        for name in ("OUTBOX_RATE", "OUTBOX_CHAT_RATE", "OUTBOX_CHAT_BURST", "OUTBOX_GROUP_RATE", "OUTBOX_GROUP_BURST"):
+            os.environ[name] = "1e9"
+    if not args.flood_limits:
+        os.environ["FLOOD_USER_RATE"] = os.environ["FLOOD_OWNER_RATE"] = "0"
+    import MKQ55596 as M
+
+    results = asyncio.run(bench(M, args))
+    print(f"db: {'postgres' if M.USING_PG else 'sqlite ' + os.environ['SQLITE_PATH']}, "
+          f"users: {args.users}, concurrency: {args.concurrency}, api latency: {args.latency}ms")
+    for name, r in results.items():
+        if name.startswith("_"):
+            continue
+        print(f"{name:10} " + "  ".join(f"{k}={v}" for k, v in r.items()))
+    print("api calls:", ", ".join(f"{k}={v}" for k, v in results["_api_calls"].items()))
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
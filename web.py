@@ -1,4 +1,6 @@
-from flask import Flask
+from flask import Flask, Response, abort, jsonify, request
+import asyncio
+import hmac
 import os
 import threading
 import MKQ55596
@@ -9,9 +11,53 @@ app = Flask(__name__)
 def home():
     return "Bot is running"
 
+@app.route("/healthz")
+def healthz():
+    _, report = MKQ55596.health_report()
+    return jsonify(report)
+
+@app.route("/readyz")
+def readyz():
+    ready, report = MKQ55596.health_report()
+    return jsonify(report), 200 if ready else 503
+
+@app.route("/metrics")
+def metrics():
+    return Response(MKQ55596.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route(MKQ55596.WEBHOOK_PATH, methods=["POST"])
+async def telegram_webhook():
+    if MKQ55596.WEBHOOK_SECRET or MKQ55596.WEBHOOK_URL:
+        # no secret is only allowed for local testing, without WEBHOOK_URL
+        got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not MKQ55596.WEBHOOK_SECRET or not hmac.compare_digest(got, MKQ55596.WEBHOOK_SECRET):
+            abort(403)
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    if not await MKQ55596.feed_webhook_update(data):
+        abort(503)
+    return ""
+
 def run_flask():
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
 
+async def serve_webhook():
+    # the Flask app and the bot share one event loop: async views run on it
+    import uvicorn
+    from asgiref.wsgi import WsgiToAsgi
+
+    server = uvicorn.Server(uvicorn.Config(
+        WsgiToAsgi(app),
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 10000)),
+        log_level="warning",
+    ))
+    await MKQ55596.run_webhook(server.serve)
+
 if __name__ == "__main__":
-    threading.Thread(target=run_flask, daemon=True).start()
-    MKQ55596.run_bot()
+    if MKQ55596.BOT_MODE == "webhook":
+        asyncio.run(serve_webhook())
+    else:
+        threading.Thread(target=run_flask, daemon=True).start()
+        MKQ55596.run_bot()